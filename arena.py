@@ -0,0 +1,124 @@
+import numpy as np
+from math import floor, sqrt
+
+# obstacle triangle (0, 160) - (700, 400) - (0, 640)
+OBSTACLE_TOP = (0, 160)
+OBSTACLE_TIP = (700, 400)
+OBSTACLE_BOTTOM = (0, 640)
+
+# edge vectors of the obstacle sides
+OBSTACLE_TOP_VECTOR = (0.35, -0.94)
+OBSTACLE_BOTTOM_VECTOR = (0.35, 0.94)
+
+
+def line_coefficients(p1, p2):
+    """(a, b, c) of the line through p1 and p2, so that |a * x + b * y + c| is the distance to it"""
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    length = sqrt(dx ** 2 + dy ** 2)
+
+    return dy / length, -dx / length, (dx * p1[1] - dy * p1[0]) / length
+
+
+def distance_to_line(line, x, y):
+    """Distance from (x, y) to the line, works for numbers and arrays"""
+    a, b, c = line
+    return abs(a * x + b * y + c)
+
+
+class Arena:
+    """
+    Geometry of the tank: walls and the obstacle triangle
+
+    Built once per simulation, so fishes don't recompute the obstacle lines
+    on every step. With resolution, also rasterizes the distance from every
+    cell to the closest wall or obstacle side, so fishes far from everything
+    get their edge vector from a single lookup.
+    """
+
+    def __init__(self, width, height, resolution=None, wall_distance=15):
+        self.width = width
+        self.height = height
+
+        self.top_line = line_coefficients(OBSTACLE_TOP, OBSTACLE_TIP)
+        self.bottom_line = line_coefficients(OBSTACLE_BOTTOM, OBSTACLE_TIP)
+
+        # obstacle sides as y = slope * x + intercept
+        self.top_slope = (OBSTACLE_TIP[1] - OBSTACLE_TOP[1]) / (OBSTACLE_TIP[0] - OBSTACLE_TOP[0])
+        self.top_intercept = OBSTACLE_TOP[1]
+        self.bottom_slope = (OBSTACLE_TIP[1] - OBSTACLE_BOTTOM[1]) / \
+            (OBSTACLE_TIP[0] - OBSTACLE_BOTTOM[0])
+        self.bottom_intercept = OBSTACLE_BOTTOM[1]
+
+        self.resolution = resolution
+        self.wall_distance = wall_distance
+        self.clearance = None
+        if resolution:
+            self.rasterize(resolution)
+
+    def rasterize(self, resolution):
+        """
+        For every resolution x resolution cell, store the smallest distance
+        from any point of the cell to the walls and obstacle lines
+        """
+        x = (np.arange(np.ceil(self.width / resolution)) + 0.5) * resolution
+        y = (np.arange(np.ceil(self.height / resolution)) + 0.5) * resolution
+        x, y = np.meshgrid(x, y, indexing='ij')
+
+        distance = np.minimum.reduce([
+            x, y, self.width - x, self.height - y,
+            distance_to_line(self.top_line, x, y),
+            distance_to_line(self.bottom_line, x, y),
+        ])
+
+        # the farthest point of a cell is half a diagonal away from it's center
+        self.clearance = distance - resolution * sqrt(2) / 2
+
+    def is_far_from_edges(self, x, y, distance):
+        """True if the rasterized field guarantees, that nothing is closer than distance"""
+        if self.clearance is None or not (0 <= x < self.width and 0 <= y < self.height):
+            return False
+
+        return self.clearance[floor(x / self.resolution), floor(y / self.resolution)] > distance
+
+    def get_edge_vector(self, x, y, distance=15):
+        """(x, y) of the edge vector of the walls and obstacle closer than distance, (0, 0) if none"""
+        if self.is_far_from_edges(x, y, distance):
+            return 0, 0
+
+        edge_x = edge_y = 0
+
+        # close to the left wall
+        if x - distance <= 0:
+            edge_x = 1
+
+        # close to the !top wall
+        if y - distance <= 0:
+            edge_y = -1
+
+        # close to the right wall
+        elif x + distance >= self.width:
+            edge_x = -1
+
+        # close to the !bottom wall
+        elif y + distance >= self.height:
+            edge_y = 1
+
+        # we can give priority to obstacle as at the left wall
+        # fish is not active anyway?
+        if distance_to_line(self.top_line, x, y) < distance:
+            edge_x, edge_y = OBSTACLE_TOP_VECTOR
+
+        if distance_to_line(self.bottom_line, x, y) < distance:
+            edge_x, edge_y = OBSTACLE_BOTTOM_VECTOR
+
+        return edge_x, edge_y
+
+    def top_obstacle_y(self, x):
+        return self.top_slope * x + self.top_intercept
+
+    def bottom_obstacle_y(self, x):
+        return self.bottom_slope * x + self.bottom_intercept
+
+    def is_inside_obstacle(self, x, y):
+        return self.top_obstacle_y(x) < y < self.bottom_obstacle_y(x)
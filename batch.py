@@ -0,0 +1,187 @@
+"""
+Headless batch runs from the command line
+
+Simulates shoals of the setups and group sizes and writes one record per
+finished shoal to a JSON lines or CSV file (chosen by the extension, or
+--format), in the order shoals finish, flushed right away, so the output can be
+tailed while the batch runs:
+
+    python3 batch.py --setups 1:1 0:3 --group-sizes 4 8 --shoals 30 --workers 8 \
+        --seed 1 --output results.jsonl
+
+Shoals get the seeds of run_set(seed=seed) (experiments.set_seeds), so every shoal
+of a batch is the same shoal as in run_set, whatever setups and group sizes are chosen.
+"""
+import argparse
+import csv
+import json
+import sys
+
+import numpy as np
+
+from experimental_setups import SETUPS
+from experiments import set_seeds
+from logs import logger, configure_logging, Progress
+from simulation import iter_shoals, effective_engine
+
+COLUMNS = ['replicas_bottom', 'replicas_top', 'fishes', 'shoal', 'seed', 'engine',
+           'follow_refugia_force', 'top', 'bottom', 'proportion']
+
+
+def parse_setup(setup):
+    """'1:3' -> (1, 3), replicas going bottom (left) : replicas going top (right)"""
+    replicas_bottom, replicas_top = setup.split(':')
+    return int(replicas_bottom), int(replicas_top)
+
+
+def get_jobs(setups=SETUPS, group_sizes=(2, 4, 8), shoals=30, seed=None, engine='fish',
+             follow_refugia_force=0.2):
+    """Records without results, one per shoal"""
+    setups = [tuple(setup) for setup in setups]
+    seeds = set_seeds(seed, shoals, setups, group_sizes)
+    # record the engine, that simulates the shoals
+    engine = effective_engine(engine)
+
+    jobs = []
+    for replicas_bottom, replicas_top in setups:
+        for fishes in group_sizes:
+            for shoal, shoal_seed in enumerate(seeds[(replicas_bottom, replicas_top, fishes)]):
+                jobs.append(dict(fishes=fishes, replicas_top=replicas_top,
+                                 replicas_bottom=replicas_bottom,
+                                 follow_refugia_force=follow_refugia_force, engine=engine,
+                                 shoal=shoal, seed=shoal_seed))
+
+    return jobs
+
+
+def get_format(output, output_format=None):
+    if output_format is not None:
+        return output_format
+
+    return 'csv' if output.endswith('.csv') else 'jsonl'
+
+
+def read_batch(path, setups=SETUPS, group_sizes=(2, 4, 8)):
+    """
+    Proportions of a run_batch output (jsonl or csv, by the extension), grouped like
+    run_set results: [setup][group size] -> proportions of the shoals in shoal order
+    """
+    index = {(tuple(setup), fishes): (i, j) for i, setup in enumerate(setups)
+             for j, fishes in enumerate(group_sizes)}
+    cells = [[{} for _ in group_sizes] for _ in setups]
+
+    with open(path, newline='') as f:
+        records = csv.DictReader(f) if get_format(path) == 'csv' else map(json.loads, f)
+        for record in records:
+            key = ((int(record['replicas_bottom']), int(record['replicas_top'])),
+                   int(record['fishes']))
+            if key in index:
+                i, j = index[key]
+                cells[i][j][int(record['shoal'])] = float(record['proportion'])
+
+    return [[[cell[shoal] for shoal in sorted(cell)] for cell in setup] for setup in cells]
+
+
+def run_batch(setups=SETUPS, group_sizes=(2, 4, 8), shoals=30, workers=None, seed=None,
+              engine='fish', follow_refugia_force=0.2, output='-', output_format=None, cache=None,
+              chunksize=1):
+    """
+    Simulate the shoals and write a record for each to output ('-' for stdout)
+    as soon as it is finished, returns the number of records
+    cache: cache.ResultCache, cached shoals are written first and not simulated
+    chunksize: shoals sent to a worker at once, see simulation.iter_shoals
+    """
+    if seed is None:
+        # so the batch can be repeated
+        seed = int(np.random.SeedSequence().entropy)
+        logger.info('root seed: %s', seed)
+
+    jobs = get_jobs(setups, group_sizes, shoals, seed, engine, follow_refugia_force)
+    output_format = get_format(output, output_format)
+
+    f = sys.stdout if output == '-' else open(output, 'w', newline='')
+    try:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS) if output_format == 'csv' else None
+        if writer is not None:
+            writer.writeheader()
+
+        def write(job, result):
+            top, bottom = result
+            record = dict(job, top=top, bottom=bottom, proportion=top / job['fishes'])
+            if writer is not None:
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+
+        configurations = [{name: job[name] for name in ('fishes', 'replicas_top', 'replicas_bottom',
+                                                        'follow_refugia_force', 'engine')}
+                          for job in jobs]
+        seeds = [job['seed'] for job in jobs]
+        missing = list(range(len(jobs)))
+
+        if cache is not None:
+            cached = cache.get_many(configurations, seeds)
+            for job, result in zip(jobs, cached):
+                if result is not None:
+                    write(job, result)
+            missing = [i for i, result in enumerate(cached) if result is None]
+
+        progress = Progress(total=len(missing))
+        results = [None] * len(missing)
+        # in the order shoals finish, with workers
+        for j, result in iter_shoals([configurations[i] for i in missing],
+                                     [seeds[i] for i in missing], workers=workers,
+                                     chunksize=chunksize):
+            write(jobs[missing[j]], result)
+            results[j] = result
+            progress.update()
+
+        if cache is not None:
+            cache.put_many([configurations[i] for i in missing], [seeds[i] for i in missing], results)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    return len(jobs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--setups", dest="setups", nargs='+', type=parse_setup,
+                        default=SETUPS,
+                        help="setups as replicas_bottom:replicas_top (default = all the SETUPS)")
+    parser.add_argument("-g", "--group-sizes", dest="group_sizes", nargs='+', type=int,
+                        default=[2, 4, 8], help="group sizes (default = 2 4 8)")
+    parser.add_argument("-n", "--shoals", dest="shoals", type=int, default=30,
+                        help="shoals per setup and group size (default = 30)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="number of processes to simulate shoals in")
+    parser.add_argument("--chunksize", dest="chunksize", type=int, default=1,
+                        help="shoals sent to a worker at once, more for short shoals (default = 1)")
+    parser.add_argument("--seed", dest="seed", type=int, default=None,
+                        help="root seed (default = random, logged)")
+    parser.add_argument("-e", "--engine", dest="engine", default='fish',
+                        choices=['fish', 'vectorized', 'jit'],
+                        help="define how the shoal is updated (default = fish)")
+    parser.add_argument("--follow-refugia-force", dest="follow_refugia_force", type=float,
+                        default=0.2, help="(default = 0.2)")
+    parser.add_argument("-o", "--output", dest="output", default='-',
+                        help="file to write the records to, - for stdout (default)")
+    parser.add_argument("--format", dest="output_format", choices=['jsonl', 'csv'], default=None,
+                        help="output format (default = csv for .csv files, jsonl otherwise)")
+    parser.add_argument("--cache", dest="cache", default=None,
+                        help="cache.ResultCache file to take and store the results in")
+    args = parser.parse_args()
+
+    configure_logging()
+
+    cache = None
+    if args.cache is not None:
+        from cache import ResultCache
+        cache = ResultCache(args.cache)
+
+    run_batch(setups=args.setups, group_sizes=args.group_sizes, shoals=args.shoals,
+              workers=args.workers, seed=args.seed, engine=args.engine,
+              follow_refugia_force=args.follow_refugia_force, output=args.output,
+              output_format=args.output_format, cache=cache, chunksize=args.chunksize)
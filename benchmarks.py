@@ -0,0 +1,178 @@
+"""
+Benchmarks of the simulation hot paths
+
+Every run appends one JSON line with the git commit and the timings of all
+the benchmarks to the output file, so runs from different commits can be compared:
+
+    python3 benchmarks.py --output benchmarks.jsonl
+    python3 benchmarks.py --quick --filter run_step
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+
+import numpy as np
+
+from experimental_setups import SETUPS
+from simulation import Simulation, headless_simulations
+from utils import random_trunc
+from vector import Vector
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    """
+    Register a benchmark: prepare(**params) returns a function to time,
+    params also hold number - how many calls to time
+    """
+    def register(prepare):
+        BENCHMARKS.append((name, params, prepare))
+        return prepare
+    return register
+
+
+def measure(func, repeats=5, number=100):
+    """Time number calls of func, repeats times, return seconds per call of every repeat"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+
+    return times
+
+
+def prepared_simulation(fishes=8, steps=30, engine='fish', seed=0):
+    """Simulation after a few steps, so fishes are spread out and not in the start box"""
+    simulation = Simulation(fishes=fishes, follow_refugia_force=0.2, engine=engine, seed=seed)
+    for _ in range(steps):
+        simulation.run_step(False)
+
+    return simulation
+
+
+@benchmark('random_trunc', number=10000)
+def random_trunc_benchmark():
+    return lambda: random_trunc(mean=2, sd=0.25, low=1.5, upp=2.5)
+
+
+@benchmark('Fish.set_closest_neighbors', fishes=8, number=1000)
+def closest_neighbors_benchmark(fishes=8):
+    simulation = prepared_simulation(fishes)
+    fish = simulation.shoal[0]
+    simulation.neighbor_grid.rebuild(simulation.shoal)
+
+    return lambda: fish.set_closest_neighbors(simulation.shoal, grid=simulation.neighbor_grid)
+
+
+@benchmark('Fish.get_edge_vector', number=10000)
+def edge_vector_benchmark():
+    fish = prepared_simulation(2, steps=0).shoal[0]
+    # close to the top obstacle side
+    fish.position = Vector(350, 290)
+
+    return lambda: fish.get_edge_vector()
+
+
+@benchmark('Fish.bounce_from_obstacle', number=1000)
+def bounce_from_obstacle_benchmark():
+    fish = prepared_simulation(2, steps=0).shoal[0]
+
+    def bounce():
+        # inside the obstacle, so the fish always bounces
+        fish.position = Vector(350, 400)
+        fish.velocity = Vector(-5, 1)
+        fish.bounce_from_obstacle()
+
+    return bounce
+
+
+@benchmark('Fish.update', fishes=8, number=200)
+def fish_update_benchmark(fishes=8):
+    simulation = prepared_simulation(fishes)
+    fish = simulation.shoal[0]
+    position = Vector(fish.position.x, fish.position.y)
+    velocity = Vector(fish.velocity.x, fish.velocity.y)
+    simulation.neighbor_grid.rebuild(simulation.shoal)
+
+    def update():
+        fish.position = Vector(position.x, position.y)
+        fish.velocity = Vector(velocity.x, velocity.y)
+        fish.update(simulation.shoal, grid=simulation.neighbor_grid)
+
+    return update
+
+
+for fishes in (2, 8, 64, 512):
+    for engine in ('fish', 'vectorized', 'jit'):
+        # the Fish engine gets slow for big shoals, time less steps
+        number = 20 if engine != 'fish' or fishes <= 8 else 2
+
+        @benchmark('Simulation.run_step', fishes=fishes, engine=engine, number=number)
+        def run_step_benchmark(fishes=fishes, engine=engine):
+            simulation = prepared_simulation(fishes, steps=5, engine=engine)
+            return lambda: simulation.run_step(False)
+
+
+for replicas_bottom, replicas_top in SETUPS:
+    for engine in ('fish', 'vectorized', 'jit'):
+        @benchmark('headless_simulations', replicas_bottom=replicas_bottom, replicas_top=replicas_top,
+                   fishes=4, shoals=3, engine=engine, number=1)
+        def headless_simulations_benchmark(replicas_bottom=replicas_bottom, replicas_top=replicas_top,
+                                           fishes=4, shoals=3, engine=engine):
+            return lambda: headless_simulations(shoals, fishes=fishes, replicas_top=replicas_top,
+                                                replicas_bottom=replicas_bottom, engine=engine, seed=0)
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(name_filter=None, repeats=5, quick=False):
+    results = []
+    for name, params, prepare in BENCHMARKS:
+        if name_filter and name_filter not in name:
+            continue
+
+        params = dict(params)
+        number = params.pop('number')
+        if quick:
+            number = max(1, number // 10)
+
+        func = prepare(**params)
+        times = measure(func, repeats=1 if quick else repeats, number=number)
+
+        result = dict(name=name, params=params, number=number, repeats=len(times),
+                      best=min(times), mean=float(np.mean(times)))
+        print(f'{name} {params}: best {result["best"] * 1e3:.3f} ms, mean {result["mean"] * 1e3:.3f} ms')
+        results.append(result)
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", dest="output", default='benchmarks.jsonl',
+                        help="file to append results to (default = benchmarks.jsonl)")
+    parser.add_argument("-f", "--filter", dest="filter", default=None,
+                        help="run only benchmarks with this in the name")
+    parser.add_argument("-r", "--repeats", dest="repeats", type=int, default=5,
+                        help="how many times every benchmark is repeated (default = 5)")
+    parser.add_argument("-q", "--quick", dest="quick", action='store_true',
+                        help="10 times less calls and one repeat, to check that everything runs")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter, repeats=args.repeats, quick=args.quick)
+    record = dict(commit=get_commit(), time=time.time(), python=platform.python_version(),
+                  numpy=np.__version__, quick=args.quick, results=results)
+
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from parameters import changed_parameters
+from simulation import effective_engine
+
+# modules that define what a simulated shoal does,
+# any change in them makes the cached results stale
+MODEL_MODULES = ['simulation.py', 'fish.py', 'shoal.py', 'arena.py', 'spatial.py', 'utils.py',
+                 'parameters.py', 'kernels.py', 'vector.py']
+
+_model_version = None
+
+
+def model_version():
+    """Hash of the sources of the model modules"""
+    global _model_version
+
+    if _model_version is None:
+        digest = hashlib.sha1()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for module in MODEL_MODULES:
+            with open(os.path.join(directory, module), 'rb') as f:
+                digest.update(f.read())
+        _model_version = digest.hexdigest()[:16]
+
+    return _model_version
+
+
+def engine_version(version, engine):
+    """
+    Model version of shoals of the engine, with the numba version for the compiled
+    engine, as compiled results can change with the compiler
+    """
+    if engine == 'jit':
+        import numba
+        return f'{version}+numba{numba.__version__}'
+
+    return version
+
+
+class ResultCache:
+    """
+    SQLite store of (top, bottom) of simulated shoals
+
+    A shoal is identified by it's configuration (fishes, replicas_top, replicas_bottom,
+    follow_refugia_force, engine, parameters, replica_seed), the model version and it's
+    seed. The engine is the one, that really simulates the shoal ('fish' for 'jit' without
+    numba) and the version of 'jit' shoals includes the numba version. Only shoals with an
+    integer seed can be cached. When there are
+    more than max_entries results, the least recently used ones are evicted.
+
+        cache = ResultCache('results_cache.sqlite')
+        headless_simulations(30, fishes=4, seed=1, cache=cache)
+    """
+
+    def __init__(self, path='results_cache.sqlite', max_entries=1000000, version=None):
+        """version: model version to key the results with, model_version() if not given"""
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version if version is not None else model_version()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                fishes INTEGER, replicas_top INTEGER, replicas_bottom INTEGER,
+                follow_refugia_force REAL, engine TEXT, version TEXT, seed INTEGER,
+                top INTEGER, bottom INTEGER, used REAL)''')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS results_used ON results (used)')
+        self.connection.commit()
+
+    def is_cacheable(self, seed):
+        return isinstance(seed, (int, np.integer)) and not isinstance(seed, bool)
+
+    def get_key(self, configuration, seed):
+        configuration = dict(configuration)
+        engine = effective_engine(configuration.get('engine', 'fish'))
+        return json.dumps([configuration.get('fishes'), configuration.get('replicas_top', 0),
+                           configuration.get('replicas_bottom', 0),
+                           configuration.get('follow_refugia_force'),
+                           engine, engine_version(self.version, engine), int(seed),
+                           # only the changed parameters, so None, {} and the defaults
+                           # given explicitly are the same shoal
+                           changed_parameters(configuration.get('parameters')),
+                           configuration.get('replica_seed')],
+                          sort_keys=True)
+
+    def get_many(self, configurations, seeds):
+        """(top, bottom) for every configuration and seed, None if not cached"""
+        results = [None] * len(configurations)
+        keys = {}
+        for i, (configuration, seed) in enumerate(zip(configurations, seeds)):
+            if self.is_cacheable(seed):
+                keys.setdefault(self.get_key(configuration, seed), []).append(i)
+
+        found = []
+        key_list = list(keys)
+        # sqlite limits the number of parameters of a query
+        for start in range(0, len(key_list), 500):
+            chunk = key_list[start:start + 500]
+            found += self.connection.execute(
+                f'SELECT key, top, bottom FROM results WHERE key IN ({",".join("?" * len(chunk))})',
+                chunk).fetchall()
+
+        for key, top, bottom in found:
+            for i in keys[key]:
+                results[i] = (top, bottom)
+
+        if found:
+            now = time.time()
+            self.connection.executemany('UPDATE results SET used = ? WHERE key = ?',
+                                        [(now, key) for key, _, _ in found])
+            self.connection.commit()
+
+        hits = sum(result is not None for result in results)
+        self.hits += hits
+        self.misses += len(results) - hits
+
+        return results
+
+    def get(self, configuration, seed):
+        return self.get_many([configuration], [seed])[0]
+
+    def put_many(self, configurations, seeds, results):
+        now = time.time()
+        rows = []
+        for configuration, seed, (top, bottom) in zip(configurations, seeds, results):
+            if not self.is_cacheable(seed):
+                continue
+
+            configuration = dict(configuration)
+            engine = effective_engine(configuration.get('engine', 'fish'))
+            rows.append((self.get_key(configuration, seed), configuration.get('fishes'),
+                         configuration.get('replicas_top', 0), configuration.get('replicas_bottom', 0),
+                         configuration.get('follow_refugia_force'),
+                         engine, engine_version(self.version, engine), int(seed),
+                         int(top), int(bottom), now))
+
+        if not rows:
+            return
+
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.evict()
+        self.connection.commit()
+
+    def put(self, configuration, seed, result):
+        self.put_many([configuration], [seed], [result])
+
+    def evict(self):
+        """Delete the least recently used results above max_entries"""
+        count = len(self)
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used LIMIT ?)',
+                (count - self.max_entries,))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM results')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM results').fetchone()[0]
@@ -0,0 +1,173 @@
+"""
+Calibration of the model against the observed decisions (results_data.frequencies_original)
+
+Candidates are drawn by Latin hypercubes over the ranges of follow_refugia_force,
+the neighbor coefficients and the distance thresholds. Every candidate is simulated
+for all the setups and group sizes and scored by the mean distance between the
+simulated and the observed distributions of proportions over the cells with observed
+data. Every round draws the candidates of the next one around the best candidate so
+far, in ranges shrunk by %shrink.
+
+All the candidates use the same shoal seeds (those of run_set(seed=seed)), so the
+differences of scores are differences of parameters, not of random numbers. Shoals
+are simulated by sweep.run_sweep, in parallel, and appended to the output CSV, so
+an interrupted calibration only simulates what is missing when it's run again:
+
+    python3 calibration.py --samples 20 --rounds 3 --shoals 20 --workers 8 --output calibration.csv
+"""
+import argparse
+import json
+
+import numpy as np
+
+from experimental_setups import SETUPS
+from hypothesis_testing import as_cells
+from logs import logger, configure_logging
+from results_data import frequencies_original
+from sweep import SWEEP_PARAMETERS, latin_hypercube, get_points, run_sweep
+
+# parameters calibrated by default and their ranges,
+# the ranges of the thresholds don't overlap, so they stay in order
+DEFAULT_RANGES = dict(
+    follow_refugia_force=(0.05, 0.5),
+    second_neighbor_turn_coefficient=(0, 0.5),
+    second_neighbor_accelerate_coefficient=(0, 0.5),
+    interaction_distance=(80, 130),
+    half_turn_distance=(35, 70),
+    strong_attraction_distance=(16, 32),
+    attraction_min_distance=(8, 14),
+    repulsion_distance=(3, 7),
+)
+
+METRICS = ['wasserstein', 'ks']
+
+
+def cell_distances(simulated, observed=None, bins_n=6, metric='wasserstein'):
+    """
+    Distances between (..., setups, group sizes, shoals) simulated proportions and
+    the observed ones (frequencies_original by default), per cell.
+    Both are binned like the histograms (bins_n - 1 bins from 0 to 1), as the observed
+    proportions are, metric: 'wasserstein' - earth mover's distance of the binned
+    distributions, 'ks' - largest difference of their cumulative distributions.
+    nan for cells without data
+    """
+    if metric not in METRICS:
+        raise ValueError(f'Unknown metric: {metric}')
+
+    def cumulative(data):
+        data = as_cells(data)
+        missing = np.isnan(data)
+        # bin of every proportion, 1 falls into the last bin
+        bins = np.clip(np.floor(np.where(missing, 0, data) * (bins_n - 1)), 0, bins_n - 2)
+        counts = ((bins[..., None] == np.arange(bins_n - 1)) & ~missing[..., None]).sum(axis=-2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.cumsum(counts, axis=-1) / counts.sum(axis=-1, keepdims=True)
+
+    differences = np.abs(cumulative(simulated) - cumulative(
+        frequencies_original if observed is None else observed))
+
+    if metric == 'ks':
+        return differences.max(axis=-1)
+
+    return differences[..., :-1].sum(axis=-1) / (bins_n - 1)
+
+
+def score(distances):
+    """Mean distance of the cells with data"""
+    return float(np.nanmean(distances))
+
+
+def point_cells(rows, points, group_sizes=(2, 4, 8)):
+    """Proportions of run_sweep rows as (points, setups, group sizes, shoals), padded with nan"""
+    setups = {tuple(setup): i for i, setup in enumerate(SETUPS)}
+    groups = {fishes: j for j, fishes in enumerate(group_sizes)}
+    shoals = max(row['shoal'] for row in rows) + 1
+
+    cells = np.full((points, len(SETUPS), len(group_sizes), shoals), np.nan)
+    for row in rows:
+        cells[row['point'], setups[(row['replicas_bottom'], row['replicas_top'])],
+              groups[row['fishes']], row['shoal']] = row['proportion']
+
+    return cells
+
+
+def narrow(ranges, best, width):
+    """Ranges of %width of ranges around best, inside ranges"""
+    narrowed = {}
+    for name, (low, high) in ranges.items():
+        half = (high - low) * width / 2
+        center = min(max(best[name], low + half), high - half)
+        narrowed[name] = (center - half, center + half)
+
+    return narrowed
+
+
+def calibrate(ranges=DEFAULT_RANGES, samples=20, rounds=3, shrink=0.5, shoals=20, seed=0,
+              engine='jit', workers=None, output='calibration.csv', cache=None,
+              metric='wasserstein', observed=None):
+    """
+    Search ranges ({name: (low, high)} of sweep.SWEEP_PARAMETERS) for the parameters,
+    that reproduce the observed proportions best, see the module docstring.
+    Returns candidates (dicts of all the sweep parameters with the round and the score)
+    from the best one
+    """
+    unknown = set(ranges) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown calibration parameters: {", ".join(sorted(unknown))}')
+
+    candidates = []
+    current = dict(ranges)
+
+    for round_ in range(rounds):
+        spec = {'points': latin_hypercube(current, samples, seed=[seed, round_]),
+                'shoals': shoals, 'seed': seed, 'engine': engine}
+        rows = run_sweep(spec, output=output, workers=workers, cache=cache)
+
+        points = get_points(spec)
+        distances = cell_distances(point_cells(rows, len(points)), observed, metric=metric)
+        for point, point_distances in zip(points, distances):
+            candidates.append(dict(point, round=round_, score=score(point_distances)))
+
+        best = min(candidates, key=lambda candidate: candidate['score'])
+        logger.info('round %s: best score %.4f', round_, best['score'],
+                    extra={'summary': best})
+        current = narrow(ranges, best, shrink ** (round_ + 1))
+
+    return sorted(candidates, key=lambda candidate: candidate['score'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ranges", dest="ranges", default=None,
+                        help="JSON file with {parameter: [low, high]} (default = DEFAULT_RANGES)")
+    parser.add_argument("--samples", dest="samples", type=int, default=20,
+                        help="candidates per round (default = 20)")
+    parser.add_argument("--rounds", dest="rounds", type=int, default=3, help="(default = 3)")
+    parser.add_argument("--shrink", dest="shrink", type=float, default=0.5,
+                        help="ranges of every round are shrunk by this (default = 0.5)")
+    parser.add_argument("-n", "--shoals", dest="shoals", type=int, default=20,
+                        help="shoals per setup and group size (default = 20)")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="(default = 0)")
+    parser.add_argument("-e", "--engine", dest="engine", default='jit',
+                        choices=['fish', 'vectorized', 'jit'], help="(default = jit)")
+    parser.add_argument("--metric", dest="metric", default='wasserstein', choices=METRICS,
+                        help="distance of the distributions (default = wasserstein)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="number of processes to simulate shoals in")
+    parser.add_argument("-o", "--output", dest="output", default='calibration.csv',
+                        help="CSV table to append the shoals to (default = calibration.csv)")
+    parser.add_argument("--top", dest="top", type=int, default=5,
+                        help="number of the best candidates to print (default = 5)")
+    args = parser.parse_args()
+
+    configure_logging()
+    ranges = DEFAULT_RANGES
+    if args.ranges is not None:
+        with open(args.ranges) as f:
+            ranges = json.load(f)
+
+    for candidate in calibrate(ranges, samples=args.samples, rounds=args.rounds,
+                               shrink=args.shrink, shoals=args.shoals, seed=args.seed,
+                               engine=args.engine, workers=args.workers, output=args.output,
+                               metric=args.metric)[:args.top]:
+        print(json.dumps(candidate))
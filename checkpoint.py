@@ -0,0 +1,105 @@
+import json
+import os
+
+import numpy as np
+
+
+class Checkpoint:
+    """
+    Append-only JSON lines file with the results of finished shoals of a sweep
+
+    The first line holds the parameters of the sweep, every next one
+    the index, seed and (top, bottom) of one shoal, written as soon as the
+    shoal is finished. Resuming a sweep with the same parameters takes
+    finished shoals from the file and simulates only the rest.
+    """
+
+    def __init__(self, path, resume=True):
+        """resume: continue the sweep saved in path, start it again if False"""
+        self.path = path
+        self.resume = resume
+        self.file = None
+
+    def start(self, **parameters):
+        """
+        Open the checkpoint for a sweep with parameters and return it's root seed:
+        the saved one when resuming, a new one when seed is None
+        """
+        saved = self.read_header() if self.resume else None
+
+        if saved is not None:
+            seed = saved.pop('seed')
+            if parameters.get('seed') is not None and parameters['seed'] != seed:
+                raise ValueError(f'Checkpoint {self.path} was made with seed {seed}, '
+                                 f'not {parameters["seed"]}')
+            parameters = dict(parameters, seed=seed)
+
+            if parameters != dict(saved, seed=seed):
+                raise ValueError(f'Checkpoint {self.path} was made with different parameters: {saved}')
+
+            self.file = open(self.path, 'a')
+            # finish the line cut when the sweep was killed
+            if self.file.tell() and not self.ends_with_newline():
+                self.file.write('\n')
+            return seed
+
+        # seed from fresh entropy, saved so the sweep can be resumed
+        if parameters.get('seed') is None:
+            parameters['seed'] = np.random.SeedSequence().entropy
+
+        self.file = open(self.path, 'w')
+        self.write(parameters)
+        return parameters['seed']
+
+    def read_header(self):
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path) as f:
+            line = f.readline()
+
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def load(self, seeds):
+        """{index: (top, bottom)} of the shoals finished with the same seeds"""
+        results = {}
+        if not self.resume or not os.path.exists(self.path):
+            return results
+
+        with open(self.path) as f:
+            # skip the parameters
+            f.readline()
+
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a killed sweep can be cut
+                    continue
+
+                i = record['shoal']
+                if i < len(seeds) and record['seed'] == int(seeds[i]):
+                    results[i] = (record['top'], record['bottom'])
+
+        return results
+
+    def add(self, index, seed, result):
+        top, bottom = result
+        self.write(dict(shoal=index, seed=int(seed), top=int(top), bottom=int(bottom)))
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,17 +1,23 @@
 import time
 import numpy as np
-from matplotlib import pyplot as plt
 
-from simulation import headless_simulations
-from plots import plot_histogram
+from simulation import headless_simulations, ensemble_simulations, check_ensemble, run_shoals, \
+    spawn_seeds, shoal_seeds
 from experimental_setups import SETUPS
+from logs import logger
+from checkpoint import Checkpoint
 
 
-def run_experiment(shoals=30, fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2):
+def run_experiment(shoals=30, fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2,
+                   engine='fish', workers=None, seed=None, cache=None):
     frequencies = headless_simulations(shoals, fishes=fishes,
                                        replicas_top=replicas_top,
                                        replicas_bottom=replicas_bottom,
-                                       follow_refugia_force=follow_refugia_force)
+                                       follow_refugia_force=follow_refugia_force,
+                                       engine=engine, workers=workers, seed=seed, cache=cache)
+
+    from matplotlib import pyplot as plt
+    from plots import plot_histogram
 
     fig, ax = plt.subplots(1, 1, constrained_layout=True)
     plot_histogram(ax,
@@ -21,43 +27,218 @@ def run_experiment(shoals=30, fishes=2, replicas_top=0, replicas_bottom=0, follo
     return frequencies
 
 
-def run_experiments(shoals=30, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2):
+def experiments_shoals(shoals=30, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2,
+                       engine='fish', seed=None, group_sizes=(2, 4, 8)):
+    """
+    configurations and seeds of every shoal of run_experiments,
+    shoals of each group size get seeds spawned from the group seed
+    """
+    configurations = []
+    seeds = []
+    for group_size, group_seed in zip(group_sizes, spawn_seeds(seed, len(group_sizes))):
+        configuration = dict(fishes=group_size, replicas_top=replicas_top,
+                             replicas_bottom=replicas_bottom,
+                             follow_refugia_force=follow_refugia_force, engine=engine)
+        configurations += [configuration] * shoals
+        seeds += shoal_seeds(group_seed, shoals)
+
+    return configurations, seeds
+
+
+def split_frequencies(results, shoals, group_sizes=(2, 4, 8)):
+    """ split (top, bottom) of shoals from experiments_shoals into proportions per group size """
+    return [[top / group_size for top, _ in results[i * shoals:(i + 1) * shoals]]
+            for i, group_size in enumerate(group_sizes)]
+
+
+def run_experiments(shoals=30, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2,
+                    engine='fish', workers=None, seed=None, cache=None, checkpoint=None, resume=True,
+                    ci_width=None, stable_verdict=None, max_shoals=None):
     """ 
     run %shoals experiments 
     for given number %replicas_top and %replicas_bottom
     for shoal sizes 2, 4 and 8
+    cache: cache.ResultCache to reuse shoals simulated before with the same seed
+    checkpoint: path of the file to save every finished shoal to
+    resume: continue the experiments saved in checkpoint instead of starting again
+    ci_width, stable_verdict, max_shoals: add shoals to every group size after the first %shoals
+    until the result is clear, see simulation.sequential_simulations
     """
     all_frequencies = []
 
     group_sizes = [2, 4, 8]
+    sequential = ci_width is not None or stable_verdict is not None
+    if sequential and checkpoint is not None:
+        raise ValueError('checkpoint is not supported with sequential stopping')
+
+    if not sequential and (workers or checkpoint is not None or cache is not None and seed is not None):
+        saved = None
+        if checkpoint is not None:
+            saved = Checkpoint(checkpoint, resume=resume)
+            seed = saved.start(run='run_experiments', shoals=shoals, replicas_top=replicas_top,
+                               replicas_bottom=replicas_bottom,
+                               follow_refugia_force=follow_refugia_force, engine=engine, seed=seed)
+
+        configurations, seeds = experiments_shoals(shoals, replicas_top, replicas_bottom,
+                                                   follow_refugia_force, engine, seed, group_sizes)
+        try:
+            results = run_shoals(configurations, seeds, workers=workers,
+                                 cache=cache if seed is not None else None, checkpoint=saved)
+        finally:
+            if saved is not None:
+                saved.close()
+
+        all_frequencies = split_frequencies(results, shoals, group_sizes)
+
+        logger.info('all frequencies: %s', all_frequencies)
+        return all_frequencies
+
+    group_seeds = spawn_seeds(seed, len(group_sizes))
     for i, group_size in enumerate(group_sizes):
-        print(f'\n\n======== Simulation for {i + 1} of {len(group_sizes)}\n' +
-              f'Group size: {group_size}, ' +
-              f'replicas top: {replicas_top},' +
-              f'replicas bottom: {replicas_bottom}')
+        logger.info('Simulation for %s of %s. Group size: %s, replicas top: %s, replicas bottom: %s',
+                    i + 1, len(group_sizes), group_size, replicas_top, replicas_bottom)
 
         frequencies = headless_simulations(shoals, fishes=group_size,
                                            replicas_top=replicas_top,
                                            replicas_bottom=replicas_bottom,
-                                           follow_refugia_force=follow_refugia_force)
+                                           follow_refugia_force=follow_refugia_force,
+                                           engine=engine, workers=workers, seed=group_seeds[i],
+                                           cache=cache, ci_width=ci_width,
+                                           stable_verdict=stable_verdict, max_shoals=max_shoals)
 
         all_frequencies.append(frequencies)
 
-    print('all frequencies:', all_frequencies)
+    logger.info('all frequencies: %s', all_frequencies)
 
     return all_frequencies
 
 
-def run_set(shoals=30, follow_refugia_force=0.2):
+def run_set(shoals=30, follow_refugia_force=0.2, engine='fish', ensemble=False, workers=None,
+            seed=None, cache=None, checkpoint=None, resume=True, ci_width=None, stable_verdict=None,
+            max_shoals=None):
+    """
+    ensemble: simulate shoals of all the setups and group sizes
+    together with ensemble_simulations (engine, workers and cache are not supported)
+    workers: spread shoals of all the setups across a pool of processes
+    seed: root seed, results are the same for any number of workers
+    cache: cache.ResultCache, only shoals that are not in it are simulated (needs seed)
+    checkpoint: path of the file to save every finished shoal to, so a killed sweep
+    can be resumed (the root seed is saved too, if seed is not given)
+    resume: continue the sweep saved in checkpoint instead of starting again
+    ci_width, stable_verdict, max_shoals: simulate more shoals for the setups and group sizes
+    with unclear results, see simulation.sequential_simulations
+    """
     start = time.time()
 
+    if ensemble and checkpoint is not None:
+        raise ValueError('checkpoint is not supported with ensemble')
+
+    sequential = ci_width is not None or stable_verdict is not None
+    if sequential and (ensemble or checkpoint is not None):
+        raise ValueError('ensemble and checkpoint are not supported with sequential stopping')
+
+    if ensemble:
+        check_ensemble(engine, workers, cache)
+        results = run_set_ensemble(shoals=shoals, follow_refugia_force=follow_refugia_force, seed=seed)
+        end = time.time()
+        logger.info('all sets time: %.2f', end - start)
+        return results
+
+    saved = None
+    if checkpoint is not None:
+        saved = Checkpoint(checkpoint, resume=resume)
+        seed = saved.start(run='run_set', shoals=shoals, follow_refugia_force=follow_refugia_force,
+                           engine=engine, seed=seed)
+
+    setup_seeds = spawn_seeds(seed, len(SETUPS))
+
+    if not sequential and (workers or saved is not None or cache is not None and seed is not None):
+        # one pool for all the shoals of all the setups
+        configurations = []
+        seeds = []
+        for setup, setup_seed in zip(SETUPS, setup_seeds):
+            c, s = experiments_shoals(shoals, replicas_bottom=setup[0], replicas_top=setup[1],
+                                      follow_refugia_force=follow_refugia_force, engine=engine,
+                                      seed=setup_seed)
+            configurations += c
+            seeds += s
+
+        try:
+            all_results = run_shoals(configurations, seeds, workers=workers,
+                                     cache=cache if seed is not None else None, checkpoint=saved)
+        finally:
+            if saved is not None:
+                saved.close()
+
+        shoals_per_setup = len(configurations) // len(SETUPS)
+        results = [split_frequencies(all_results[i * shoals_per_setup:(i + 1) * shoals_per_setup],
+                                     shoals)
+                   for i in range(len(SETUPS))]
+
+        end = time.time()
+        logger.info('all sets time: %.2f', end - start)
+        return results
+
     results = []
-    for setup in SETUPS:
+    for setup, setup_seed in zip(SETUPS, setup_seeds):
         r = run_experiments(shoals=shoals, replicas_bottom=setup[0], replicas_top=setup[1], 
-            follow_refugia_force=follow_refugia_force)
+            follow_refugia_force=follow_refugia_force, engine=engine, seed=setup_seed,
+            workers=workers, cache=cache, ci_width=ci_width, stable_verdict=stable_verdict,
+            max_shoals=max_shoals)
         results.append(r)
 
     end = time.time()
-    print(f'\n all sets time: {end - start:.2f}')
+    logger.info('all sets time: %.2f', end - start)
+
+    return results
+
+
+def shoal_seed(seed, setup_index, group_index, shoal_index):
+    """
+    seed run_set(seed=seed) used for one shoal, e.g. to re-run it alone
+    with headless_simulation(seed=...) and capture it's trajectory
+    """
+    setup_seed = spawn_seeds(seed, setup_index + 1)[setup_index]
+    group_seed = spawn_seeds(setup_seed, group_index + 1)[group_index]
+
+    return shoal_seeds(group_seed, shoal_index + 1)[shoal_index]
+
+
+def set_seeds(seed, shoals, setups=SETUPS, group_sizes=(2, 4, 8)):
+    """
+    {(replicas_bottom, replicas_top, fishes): shoal seeds} of run_set(seed=seed) for any
+    setups and group sizes, setups and group sizes, that run_set doesn't have,
+    get seeds spawned after it's ones
+    """
+    setups = [tuple(setup) for setup in setups]
+    all_setups = SETUPS + [setup for setup in setups if setup not in SETUPS]
+    all_group_sizes = [2, 4, 8] + [size for size in group_sizes if size not in (2, 4, 8)]
+
+    seeds = {}
+    for setup, setup_seed in zip(all_setups, spawn_seeds(seed, len(all_setups))):
+        if setup not in setups:
+            continue
+
+        group_seeds = dict(zip(all_group_sizes, spawn_seeds(setup_seed, len(all_group_sizes))))
+        for group_size in group_sizes:
+            seeds[setup + (group_size,)] = shoal_seeds(group_seeds[group_size], shoals)
+
+    return seeds
+
+
+def run_set_ensemble(shoals=30, follow_refugia_force=0.2, group_sizes=(2, 4, 8), seed=None):
+    """ run_set, with all the shoals simulated in one ensemble """
+    configurations = []
+    cells = []
+    for i, setup in enumerate(SETUPS):
+        for j, group_size in enumerate(group_sizes):
+            for k in range(shoals):
+                configurations.append((group_size, setup[1], setup[0]))
+                cells.append((i, j, k))
+
+    results = [[[None] * shoals for _ in group_sizes] for _ in SETUPS]
+    for shoal, top, bottom in ensemble_simulations(configurations, follow_refugia_force, seed=seed):
+        i, j, k = cells[shoal]
+        results[i][j][k] = top / group_sizes[j]
 
     return results
@@ -1,14 +1,66 @@
 import numpy as np
 
 from math import degrees
-from p5 import Vector, stroke, circle
-from utils import random_trunc
+from arena import Arena, OBSTACLE_TOP_VECTOR, OBSTACLE_BOTTOM_VECTOR
+from logs import logger
+from parameters import get_parameters
+from utils import TruncatedNormalSampler, sampler as default_sampler
+from vector import Vector
+
+
+def replica_path(sampler, x, y, velocity_x, velocity_y, min_x, block=256):
+    """
+    Positions and velocities ((T, 2) arrays) of a replica after each of it's
+    updates (Fish.update_replica) until it is left of min_x
+
+    A replica keeps it's direction, only the speed changes: s' = s + a with
+    a = -0.24 * s + 1.54 + noise (sd 0.3), so speeds are a linear recursion of
+    noise, drawn in blocks and summed with a convolution. The (-10, 20) bounds of a
+    are more than 20 sd away from the mean at any speed, the noise is truncated
+    at 7 (23 sd) instead
+    """
+    speed = np.hypot(velocity_x, velocity_y)
+    direction = np.array([velocity_x, velocity_y]) / speed
+
+    # s[t] = 0.76 ** (t + 1) * s[-1] + sum of 0.76 ** (t - j) * (1.54 + noise[j]) for j <= t
+    decay = 0.76 ** np.arange(block + 1)
+
+    speeds = []
+    distance = 0.0
+    # left of min_x after travelling this distance (replicas swim to x = 0)
+    min_distance = (min_x - x) / direction[0]
+
+    while distance <= min_distance:
+        noise = sampler.sample(0, 0.3, -7, 7, size=block)
+        block_speeds = np.convolve(1.54 + noise, decay[:block])[:block] + decay[1:] * speed
+        block_distance = distance + np.cumsum(block_speeds)
+
+        # stop at the first update, that moves the replica left of min_x
+        past = np.flatnonzero(block_distance > min_distance)
+        if len(past):
+            block_speeds = block_speeds[:past[0] + 1]
+            block_distance = block_distance[:past[0] + 1]
+
+        speeds.append(block_speeds)
+        speed, distance = block_speeds[-1], block_distance[-1]
+
+    speeds = np.concatenate(speeds)
+    velocities = speeds[:, None] * direction
+    positions = np.array([x, y]) + np.cumsum(velocities, axis=0)
+
+    return positions, velocities
 
 
 class Fish():
 
     def __init__(self, x, y, width, height, shaded_area_x, replica_final_y=80,
-                 replica=False, decision_x=None, follow_refugia_force=None):
+                 replica=False, decision_x=None, follow_refugia_force=None, arena=None,
+                 rng=None, sampler=None, parameters=None):
+        """
+        rng: np.random.Generator the fish draws from, global np.random if not given
+        sampler: utils.TruncatedNormalSampler, Simulation shares one between all the fishes
+        parameters: dict of behavioral constants to change, see parameters.DEFAULT_PARAMETERS
+        """
         self.position = Vector(x, y)
         self.replica = replica
         self.decision_x = decision_x
@@ -17,29 +69,39 @@ class Fish():
         self.shaded_area_x = shaded_area_x
         self.follow_refugia_force = follow_refugia_force
 
-        self.second_neighbor_turn_coefficient = 0.2
-        self.second_neighbor_accelerate_coefficient = 0.2
+        if rng is not None:
+            self.rng = rng
+            self.sampler = sampler if sampler is not None else TruncatedNormalSampler(rng)
+        else:
+            self.rng = np.random
+            self.sampler = sampler if sampler is not None else default_sampler
+
+        # second_neighbor_turn_coefficient, max_speed, distance thresholds, ...
+        for name, value in get_parameters(parameters).items():
+            setattr(self, name, value)
 
-        vec = (np.random.rand(2) - 0.5) * 10
+        vec = (self.rng.random(2) - 0.5) * 10
         if not replica:
             # random initial speed
             self.velocity = Vector(*vec)
-            print(self.velocity.magnitude)
+            logger.debug('initial speed: %s', self.velocity.magnitude)
         else:
             # get speed from initial vector
             # speed = float(Vector(*vec).magnitude)
             speed = 8
-            print('speed')
-            print(speed)
+            logger.debug('replica speed: %s', speed)
             # set speed to direction of replica path
-            self.velocity = Vector(-x, replica_final_y - y).normalize()
+            # (normalize changes the vector itself, returns None)
+            self.velocity = Vector(-x, replica_final_y - y)
+            self.velocity.normalize()
             self.velocity = self.velocity + self.velocity * speed
 
-        self.max_speed = 17
         # self.max_speed = 10
 
         self.width = width
         self.height = height
+        # walls and obstacle, Simulation shares one arena between all the fishes
+        self.arena = arena if arena is not None else Arena(width, height)
 
     def update_replica(self):
         # print('update replica')
@@ -48,37 +110,55 @@ class Fish():
 
         self.position += self.velocity
 
-    def update(self, fishes):
+    def update(self, fishes, grid=None, profiler=None):
+        """
+        grid: optional spatial.NeighborGrid to look up neighbors in instead of fishes
+        profiler: profiling.Profiler to time the phases of the update with
+        """
         # TODO behaviour is a sum or this two things!
         # TODO - add random movement?
         # when fish has no effect of other neighbors
         if self.replica:
             self.update_replica()
+            if profiler:
+                profiler.lap('replicas')
             return
 
         if self.reached_shaded_area:
+            if profiler:
+                profiler.lap('decision bookkeeping')
             return
 
         # validate if fish crossed decision line the first time
         if not self.decision and self.position.x < self.decision_x:
-            print('fish made decision!')
             self.decision = 'top' if self.position.y < self.height / 2 else 'bottom'
-            print(f'decision: {self.decision}')
+            logger.debug('fish made decision: %s', self.decision)
 
         if self.position.x < self.shaded_area_x:
             self.reached_shaded_area = True
-            print('fish reached shaded area!')
+            logger.debug('fish reached shaded area')
             # put fish inside the shaded area
             self.velocity = Vector(0, 0)
             self.position.x = 10
             self.position.y = 10 if self.position.y < self.height / 2 else self.height - 10
 
+            if profiler:
+                profiler.lap('decision bookkeeping')
             return
 
-        self.set_closest_neighbors(fishes)
+        if profiler:
+            profiler.lap('decision bookkeeping')
+
+        self.set_closest_neighbors(fishes, grid=grid)
+
+        if profiler:
+            profiler.lap('neighbor search')
 
         standard_acceleration = self.get_standard_acceleration()
 
+        if profiler:
+            profiler.lap('standard acceleration')
+
         # get turning angle
         turning_angle_closest = self.get_turning_angle_for_neighbor(self.first_closest)
         turning_angle_2nd_closest = self.get_turning_angle_for_neighbor(
@@ -105,13 +185,16 @@ class Fish():
         # if there are no neighbors
         elif turning_angle == 0:
             # turn a little bit randomly
-            turning_angle = random_trunc(mean=0, sd=0.4, low=-10, upp=10)
+            turning_angle = self.sampler.draw(mean=0, sd=0.4, low=-10, upp=10)
 
         # change fish direction,
         # rotating velocity vector by the turning angle
         # (changes the object itself, returns None)
         self.velocity.rotate(turning_angle)
 
+        if profiler:
+            profiler.lap('turning')
+
         # get acceleration
         # neighbor_acceleration = 0
         neighbor_acceleration_closest = self.get_acceleration_for_neighbor(
@@ -122,8 +205,14 @@ class Fish():
         # this is not very exact, as acceleration should have directions?
         neighbor_acceleration = neighbor_acceleration_closest + neighbor_acceleration_2nd_closest
 
+        if profiler:
+            profiler.lap('neighbor acceleration')
+
         walls_acceleration = self.get_walls_acceleration()
 
+        if profiler:
+            profiler.lap('wall acceleration')
+
         # acceleration is a sum of accelerations influenced
         # by neighbor and by walls
         acceleration = standard_acceleration + neighbor_acceleration + walls_acceleration
@@ -139,12 +228,21 @@ class Fish():
 
         self.position += self.velocity
 
+        if profiler:
+            profiler.lap('movement')
+
         # after all updates are finished, ensure fish did not go out of edge
         # and adjust if necessary
         self.bounce_from_edge()
 
+        if profiler:
+            profiler.lap('edge bounce')
+
         self.bounce_from_obstacle()
 
+        if profiler:
+            profiler.lap('obstacle bounce')
+
     def update_one(self, fishes):
         # TODO behaviour is a sum or this two things!
         # TODO - add random movement?
@@ -179,7 +277,7 @@ class Fish():
         # standard acceleration depends on velocity (Fig. 2.D)
         # as -0.24x + 1.54
         standard_acceleration = -0.24 * self.velocity.magnitude + 1.54
-        standard_acceleration = random_trunc(
+        standard_acceleration = self.sampler.draw(
             mean=standard_acceleration, sd=0.3, low=-10, upp=20)
 
         return standard_acceleration
@@ -214,7 +312,7 @@ class Fish():
         # turning_angle = 0.51 * np.sin(angle + 0.01) - 0.05
         turning_angle = 0.51 * np.sin(angle + 0.01)
 
-        turning_angle = random_trunc(mean=turning_angle, sd=0.1,
+        turning_angle = self.sampler.draw(mean=turning_angle, sd=0.1,
                                      low=turning_angle - 0.4, upp=turning_angle + 0.4)
         turning_angle = self.normalize_angle(turning_angle)
 
@@ -231,10 +329,10 @@ class Fish():
         angle = self.get_angle_with_neighbor(neighbor)
         distance = self.position.distance(neighbor.position)
 
-        if distance < 100:
+        if distance < self.interaction_distance:
             turning_angle = self.get_turning_angle(angle)
 
-            if distance > 50:
+            if distance > self.half_turn_distance:
                 # half strength if fish is far away
                 turning_angle = turning_angle * 0.5
 
@@ -265,26 +363,26 @@ class Fish():
 
         # cases:
         # 1. Strong attraction
-        if distance_to_neighbor > 10 and distance_to_neighbor <= 100:
+        if self.attraction_min_distance < distance_to_neighbor <= self.interaction_distance:
             # 1.1. If neighbor in front - accelerate towards it
             if neighbor_in_front:
-                if distance_to_neighbor > 25:
-                    acceleration = random_trunc(mean=2, sd=0.25, low=1.5, upp=2.5)
+                if distance_to_neighbor > self.strong_attraction_distance:
+                    acceleration = self.sampler.draw(mean=2, sd=0.25, low=1.5, upp=2.5)
                 else:
-                    acceleration = random_trunc(mean=1.5, sd=0.25, low=0.5, upp=1.5)
+                    acceleration = self.sampler.draw(mean=1.5, sd=0.25, low=0.5, upp=1.5)
 
             # 1.1. If neighbor in behind - decelerate
             else:
-                acceleration = random_trunc(mean=-1, sd=0.25, low=-1.5, upp=-0.5)
+                acceleration = self.sampler.draw(mean=-1, sd=0.25, low=-1.5, upp=-0.5)
 
         # 2. Strong repulsion (when fish closer than 4.06 centimeters)
-        elif distance_to_neighbor < 6:
+        elif distance_to_neighbor < self.repulsion_distance:
             if neighbor_in_front:
-                acceleration = random_trunc(mean=-1, sd=0.25, low=-1.5, upp=-0.5)
+                acceleration = self.sampler.draw(mean=-1, sd=0.25, low=-1.5, upp=-0.5)
 
             # accelerate a little bit if there's someone directly behind us
             else:
-                acceleration = random_trunc(mean=2, sd=0.25, low=1.5, upp=2.5)
+                acceleration = self.sampler.draw(mean=2, sd=0.25, low=1.5, upp=2.5)
 
         # 3. When fish is between 4.06 and 7.9 - do nothing
         # TODO maybe some random stuff??
@@ -292,21 +390,38 @@ class Fish():
         return acceleration * coefficient
 
     def show(self):
+        from p5 import stroke, circle
+
         stroke(255)
 
         circle((self.position.x, self.position.y), radius=10)
 
-    def set_closest_neighbors(self, fishes):
+    def set_closest_neighbors(self, fishes, grid=None):
         first_closest = None
         closest_distance = np.inf
 
         second_closest_distance = np.inf
         second_closest = None
+
+        # neighbors further than grid cell size have no effect on the fish,
+        # so only the fishes from the cells around are checked
+        if grid is not None:
+            fishes = grid.get_candidates(self.position)
+            max_distance = grid.cell_size
+        else:
+            max_distance = np.inf
+
         for neighbor in fishes:
             # skip self!
             if self == neighbor:
                 continue
 
+            # fishes further than the second closest can't change anything,
+            # no need to check if they are visible
+            distance = self.position.distance(neighbor.position)
+            if distance > max_distance or distance >= second_closest_distance:
+                continue
+
             # we should be able to see this neighbor!
             # as fish vision is not 360 degrees
             angle = self.get_angle_with_neighbor(neighbor)
@@ -314,7 +429,6 @@ class Fish():
             blind_back = np.pi / 15
 
             if angle < np.pi - blind_back and angle > -np.pi + blind_back:
-                distance = self.position.distance(neighbor.position)
                 if distance < closest_distance:
                     second_closest = first_closest
                     second_closest_distance = closest_distance
@@ -341,72 +455,34 @@ class Fish():
 
         # get edge vector considering maximum reaction distance
         # of 15 centimeters
-        edge_vector = self.get_edge_vector(distance=distance)
-        angle = edge_vector.angle_between(self.velocity)
-
+        edge_x, edge_y = self.arena.get_edge_vector(self.position.x, self.position.y,
+                                                    distance=distance)
 
         # close to the wall
-        if edge_vector.magnitude:
+        if edge_x or edge_y:
+            angle = Vector(edge_x, edge_y).angle_between(self.velocity)
+
             # is in "escaping the wall" mode
             # when angle between fish and wall is small
             if np.pi / 2 - np.pi / 6 < angle < np.pi / 2 + np.pi / 6:
-                walls_acceleration = random_trunc(mean=2, sd=0.5, low=1, upp=3)
+                walls_acceleration = self.sampler.draw(mean=2, sd=0.5, low=1, upp=3)
                 # walls_acceleration = 1
             
             # approaching to the wall
             elif angle > np.pi / 2 or angle < -np.pi / 2:
-                walls_acceleration = random_trunc(mean=-0.5, sd=0.1, low=-1, upp=0)
+                walls_acceleration = self.sampler.draw(mean=-0.5, sd=0.1, low=-1, upp=0)
 
         return walls_acceleration
 
     def get_edge_vector(self, distance=15):
-        edge_vector = Vector(*np.zeros(2))
-
-        # close to the left wall
-        if self.position.x - distance <= 0:
-            edge_vector.x = 1
-
-        # close to the !top wall
-        if self.position.y - distance <= 0:
-            edge_vector.y = -1
-
-        # close to the right wall
-        elif self.position.x + distance >= self.width:
-            edge_vector.x = -1
-
-        # close to the !bottom wall
-        elif self.position.y + distance >= self.height:
-            edge_vector.y = 1
-
-        # if obstacle is close
-        p3 = np.asarray((self.position.x, self.position.y))
-        p2 = np.asarray((700, 400))
-
-        p1 = np.asarray((0, 160))
-        distance_top_obstacle = np.linalg.norm(
-            np.cross(p2 - p1, p1 - p3)) / np.linalg.norm(p2 - p1)
-
-        # we can give priority to obstacle as at the left wall
-        # fish is not active anyway?
-        if distance_top_obstacle < distance:
-            edge_vector = Vector(0.35, -0.94)
-
-        p1 = np.asarray((0, 640))
-        distance_bottom_obstacle = np.linalg.norm(
-            np.cross(p2 - p1, p1 - p3)) / np.linalg.norm(p2 - p1)
-
-        # we can give priority to obstacle as at the left wall
-        # fish is not active anyway?
-        if distance_bottom_obstacle < distance:
-            edge_vector = Vector(0.35, 0.94)
-
-        return edge_vector
+        return Vector(*self.arena.get_edge_vector(self.position.x, self.position.y,
+                                                  distance=distance))
 
     def bottom_obstacle_y(self, x):
-        return -12 / 35 * x + 640
+        return self.arena.bottom_obstacle_y(x)
 
     def top_obstacle_y(self, x):
-        return 12 / 35 * x + 160
+        return self.arena.top_obstacle_y(x)
 
     def bounce_from_obstacle(self):
         x0 = self.position.x
@@ -423,8 +499,8 @@ class Fish():
         # but it should be less, than 0, as coordinate start from top left angle
         if y_top < y0 < y_bottom:
             # print('in triangle!')
-            top_vector = Vector(0.35, -0.94)
-            bottom_vector = Vector(0.35, 0.94)
+            top_vector = Vector(*OBSTACLE_TOP_VECTOR)
+            bottom_vector = Vector(*OBSTACLE_BOTTOM_VECTOR)
 
             # define if approached from top
             # angle between top vector and velocity (direction)
@@ -435,7 +511,7 @@ class Fish():
             angle_with_bottom = self.get_angle_normalized(
                 self.velocity.angle, bottom_vector.angle)
 
-            bounce_factor_angle = random_trunc(mean=0.1, sd=0.05, low=0.08, upp=0.2)
+            bounce_factor_angle = self.sampler.draw(mean=0.1, sd=0.05, low=0.08, upp=0.2)
 
             # bounce from top
             if y0 - y_top < y_bottom - y0:
@@ -491,7 +567,7 @@ class Fish():
         # bigger - fish spend less time close to the wall
         # separation = 0.15
         # variance = 0.15
-        bounce_factor = random_trunc(mean=0.1, sd=0.05, low=0.05, upp=0.15)
+        bounce_factor = self.sampler.draw(mean=0.1, sd=0.05, low=0.05, upp=0.15)
         # print(bounce_factor)
         # bounce_factor = 0.1
 
@@ -1,23 +1,9 @@
+from functools import lru_cache
+
 import numpy as np
 import scipy.stats
 
-
-def generate_random_distribution(top=1, bottom=1, fishes=2):
-    distribution = []
-    probability = top / (top + bottom)
-
-    for i in range(30):
-        top = 0
-
-        for i in range(fishes):
-            if probability > np.random.random():
-                top += 1
-
-        proportion = top / fishes
-
-        distribution.append(proportion)
-
-    return distribution
+from results_data import frequencies_original
 
 
 def test_significance(d1, d2):
@@ -37,18 +23,285 @@ def verbose_significance(p):
         return '***'
 
 
+@lru_cache(maxsize=None)
+def binomial_null(fishes, probability=0.5):
+    """
+    (proportions, cdf) of the exact distribution of the proportion of fishes
+    going top, when every fish goes top with probability independently
+    """
+    top = np.arange(fishes + 1)
+    proportions = top / fishes
+    cdf = scipy.stats.binom.cdf(top, fishes, probability)
+    # shared by all the calls
+    proportions.flags.writeable = False
+    cdf.flags.writeable = False
+
+    return proportions, cdf
+
+
+@lru_cache(maxsize=None)
+def ks_transitions(fishes, shoals, probability=0.5):
+    """
+    Transition matrices of the number of shoals with proportion <= top / fishes,
+    from top - 1 to top, for samples of %shoals shoals from binomial_null
+    """
+    pmf = scipy.stats.binom.pmf(np.arange(fishes + 1), fishes, probability)
+    below = np.concatenate(([0], np.cumsum(pmf)[:-1]))
+    counts = np.arange(shoals + 1)
+
+    transitions = []
+    for p, p_below in zip(pmf, below):
+        # shoals not counted yet are at top with probability p / (1 - p_below)
+        p_next = min(p / (1 - p_below), 1) if p_below < 1 else 1
+        transition = scipy.stats.binom.pmf(counts[None, :] - counts[:, None], shoals - counts[:, None],
+                                           p_next)
+        transition.flags.writeable = False
+        transitions.append(transition)
+
+    return transitions
+
+
+def ks_p_values(statistics, fishes, shoals, probability=0.5):
+    """
+    Exact P(D >= statistic) for the one sample KS test of %shoals proportions
+    against binomial_null, for an array of statistics
+    """
+    _, cdf = binomial_null(fishes, probability)
+    counts = np.arange(shoals + 1)
+
+    # probability of every count, for the paths that stayed closer than statistic
+    paths = np.zeros((len(statistics), shoals + 1))
+    paths[:, 0] = 1
+    for transition, f in zip(ks_transitions(fishes, shoals, probability), cdf):
+        paths = paths @ transition
+        paths[np.abs(counts / shoals - f)[None, :] >= statistics[:, None] - 1e-9] = 0
+
+    return np.clip(1 - paths.sum(axis=1), 0, 1)
+
+
+def null_ks_tests(proportions, fishes, probability=0.5):
+    """
+    One sample KS tests of proportions of shoals against binomial_null,
+    all cells (e.g. setups x group sizes) at once
+    proportions: (..., shoals) array, None or nan for missing shoals
+    fishes: group size, one for all the cells or an array with a value per cell
+    returns (statistics, p values) arrays with a value per cell, nan for cells without shoals
+
+    P values are exact for the discrete null (see ks_p_values), not the ones
+    of the continuous KS distribution, that are too conservative here
+    """
+    proportions = np.asarray(proportions, dtype=float)
+    cells_shape = proportions.shape[:-1]
+    fishes = np.broadcast_to(fishes, cells_shape)
+    shoals = np.sum(~np.isnan(proportions), axis=-1)
+
+    statistics = np.full(cells_shape, np.nan)
+    p_values = np.full(cells_shape, np.nan)
+
+    for group_size in np.unique(fishes):
+        cells = (fishes == group_size) & (shoals > 0)
+        support, cdf = binomial_null(int(group_size), probability)
+
+        # empirical cdf at every possible proportion, nan is never counted,
+        # proportions computed as top / fishes can be a bit off
+        empirical_cdf = np.sum(proportions[cells][..., None] <= support + 1e-9, axis=-2) \
+            / shoals[cells][:, None]
+        # both cdfs only jump at the support, so this is the sup distance
+        statistics[cells] = np.max(np.abs(empirical_cdf - cdf), axis=-1)
+
+        for n in np.unique(shoals[cells]):
+            same_size = cells & (shoals == n)
+            p_values[same_size] = ks_p_values(statistics[same_size], int(group_size), int(n),
+                                              probability)
+
+    return statistics, p_values
+
+
+def as_cells(data):
+    """
+    (setups, group sizes, shoals) float array of nested lists of proportions, cells with
+    less shoals (e.g. run_set with sequential stopping) and None are padded with nan
+    """
+    try:
+        return np.asarray(data, dtype=float)
+    except ValueError:
+        cells = [[np.asarray(cell, dtype=float) for cell in row] for row in data]
+        shoals = max(len(cell) for row in cells for cell in row)
+
+        return np.array([[np.pad(cell, (0, shoals - len(cell)), constant_values=np.nan)
+                          for cell in row] for row in cells])
+
+
+def significance_table(data, group_sizes=(2, 4, 8), probability=0.5):
+    """
+    p values of null_ks_tests for (setups, group sizes, shoals) data,
+    e.g. experiments.run_set results or results_data.frequencies_original
+    """
+    data = as_cells(data)
+    _, p_values = null_ks_tests(data, np.broadcast_to(group_sizes, data.shape[:-1]), probability)
+
+    return p_values
+
+
 def distribution_significance(dist, fishes):
     """ 
-    distribution significance for rejecting two null-hypothesis:
-    1. fishes move random
-    2. fished follow replica in proportion
+    distribution significance for rejecting the null-hypothesis, that fishes move random,
+    with the KS test against the exact binomial distribution (null_ks_tests)
+    """
+    _, p = null_ks_tests(dist, fishes)
+
+    return verbose_significance(float(p))
+
+
+def mean_confidence_interval(proportions, confidence=0.95):
+    """(low, high) of Student's t confidence interval of the mean proportion"""
+    proportions = np.asarray(proportions, dtype=float)
+    n = len(proportions)
+    mean = proportions.mean()
+
+    if n < 2:
+        return -np.inf, np.inf
+
+    half_width = scipy.stats.t.ppf((1 + confidence) / 2, n - 1) * \
+        proportions.std(ddof=1) / np.sqrt(n)
+
+    return mean - half_width, mean + half_width
+
+
+def cell_means(proportions):
+    """Mean of every cell of (..., shoals) proportions without the nan, nan for empty cells"""
+    with np.errstate(invalid='ignore'):
+        return np.nansum(proportions, axis=-1) / np.sum(~np.isnan(proportions), axis=-1)
+
+
+def group_by_shoals(proportions):
+    """
+    Cells of (..., shoals) proportions grouped by the number of shoals they have:
+    {shoals: (flat indexes of the cells, (cells, shoals) array of their proportions)}
     """
-    ps = []
-    for i in range(15):
-        swim_random_dist = generate_random_distribution(1, 1, fishes)
-        _, p = scipy.stats.ks_2samp(dist, swim_random_dist)
-        ps.append(p)
+    flat = proportions.reshape(-1, proportions.shape[-1])
+    valid = ~np.isnan(flat)
+    shoals = valid.sum(axis=1)
+
+    groups = {}
+    for n in np.unique(shoals[shoals > 0]):
+        cells = np.flatnonzero(shoals == n)
+        groups[int(n)] = cells, flat[cells][valid[cells]].reshape(len(cells), n)
+
+    return groups
+
+
+def bootstrap_means(proportions, resamples=10000, rng=None, chunk=1000):
+    """
+    Means of %resamples bootstrap resamples of every cell of (..., shoals) proportions
+    (nan for missing shoals), returns (resamples, ...) array, nan for cells without shoals
+    rng: np.random.Generator or seed
+    chunk: resamples drawn at once, to limit the memory
+    """
+    rng = np.random.default_rng(rng)
+    proportions = as_cells(proportions)
+    cells_shape = proportions.shape[:-1]
+    means = np.full((resamples, int(np.prod(cells_shape))), np.nan)
+
+    for n, (cells, values) in group_by_shoals(proportions).items():
+        rows = np.arange(len(cells))[None, :, None]
+        for start in range(0, resamples, chunk):
+            size = min(chunk, resamples - start)
+            indexes = rng.integers(0, n, size=(size, len(cells), n))
+            means[start:start + size, cells] = values[rows, indexes].mean(axis=-1)
+
+    return means.reshape((resamples,) + cells_shape)
+
+
+def percentile_interval(samples, confidence=0.95):
+    """(low, high) percentile interval of (resamples, ...) samples, for every cell"""
+    tail = (1 - confidence) / 2 * 100
+    with np.errstate(invalid='ignore'):
+        low, high = np.percentile(samples, [tail, 100 - tail], axis=0)
+
+    return low, high
+
+
+def bootstrap_intervals(proportions, resamples=10000, confidence=0.95, rng=None):
+    """(means, lows, highs) of the percentile bootstrap intervals of the mean of every cell"""
+    proportions = as_cells(proportions)
+    means = bootstrap_means(proportions, resamples, rng)
+
+    return (cell_means(proportions),) + percentile_interval(means, confidence)
+
+
+def permutation_tests(simulated, observed, resamples=10000, rng=None, chunk=1000):
+    """
+    Two sided permutation tests of the difference of the mean proportions of
+    simulated and observed shoals, every cell of the (..., shoals) arrays at once
+    returns (differences, p values), nan for cells without simulated or observed shoals
+    """
+    rng = np.random.default_rng(rng)
+    simulated = as_cells(simulated)
+    observed = as_cells(observed)
+    cells_shape = simulated.shape[:-1]
+
+    simulated_flat = simulated.reshape(-1, simulated.shape[-1])
+    observed_flat = observed.reshape(-1, observed.shape[-1])
+    simulated_shoals = np.sum(~np.isnan(simulated_flat), axis=1)
+    observed_shoals = np.sum(~np.isnan(observed_flat), axis=1)
+
+    differences = cell_means(simulated_flat) - cell_means(observed_flat)
+    p_values = np.full(len(differences), np.nan)
+
+    sizes = set(zip(simulated_shoals, observed_shoals))
+    for n_simulated, n_observed in sizes:
+        cells = np.flatnonzero((simulated_shoals == n_simulated) & (observed_shoals == n_observed))
+        if not n_simulated or not n_observed:
+            continue
+
+        # both samples of every cell together, simulated first
+        pooled = np.concatenate([
+            simulated_flat[cells][~np.isnan(simulated_flat[cells])].reshape(len(cells), n_simulated),
+            observed_flat[cells][~np.isnan(observed_flat[cells])].reshape(len(cells), n_observed)],
+            axis=1)
+        total = pooled.sum(axis=1)
+        rows = np.arange(len(cells))[None, :, None]
+
+        extreme = np.zeros(len(cells))
+        for start in range(0, resamples, chunk):
+            size = min(chunk, resamples - start)
+            # random permutations, the first n_simulated are the simulated sample
+            order = np.argsort(rng.random((size, len(cells), n_simulated + n_observed)), axis=-1)
+            simulated_sum = pooled[rows, order[..., :n_simulated]].sum(axis=-1)
+            permuted = simulated_sum / n_simulated - (total - simulated_sum) / n_observed
+            extreme += np.sum(np.abs(permuted) >= np.abs(differences[cells]) - 1e-12, axis=0)
+
+        p_values[cells] = (extreme + 1) / (resamples + 1)
+
+    return differences.reshape(cells_shape), p_values.reshape(cells_shape)
+
+
+def compare_to_observed(simulated, observed=frequencies_original, resamples=10000,
+                        confidence=0.95, seed=None):
+    """
+    Bootstrap intervals and permutation tests of simulated proportions against
+    the observed ones, for all the setups x group sizes at once
+    simulated: (setups, group sizes, shoals) proportions, e.g. experiments.run_set results
+    returns dict of (setups, group sizes) arrays, nan where there is no data
+    """
+    simulated = as_cells(simulated)
+    observed = as_cells(observed)
+    simulated_rng, observed_rng, permutation_rng = (
+        np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(3))
+
+    simulated_means = bootstrap_means(simulated, resamples, simulated_rng)
+    observed_means = bootstrap_means(observed, resamples, observed_rng)
+    differences, p_values = permutation_tests(simulated, observed, resamples, permutation_rng)
 
-    p_mean = np.mean(ps)
+    comparison = dict(simulated_mean=cell_means(simulated), observed_mean=cell_means(observed),
+                      difference=differences)
+    comparison['simulated_low'], comparison['simulated_high'] = \
+        percentile_interval(simulated_means, confidence)
+    comparison['observed_low'], comparison['observed_high'] = \
+        percentile_interval(observed_means, confidence)
+    comparison['difference_low'], comparison['difference_high'] = \
+        percentile_interval(simulated_means - observed_means, confidence)
+    comparison['p_value'] = p_values
 
-    return verbose_significance(p_mean)
+    return comparison
@@ -0,0 +1,390 @@
+"""
+Compiled step of a whole shoal, used by Simulation(engine='jit')
+
+The rules are the ones of fish.Fish, applied to the arrays of shoal.VectorizedShoal
+fish by fish, so like in the Fish loop every fish sees the new positions of
+the fishes updated before it. Functions are compiled with numba, if it is installed,
+and cached on disk (in __pycache__, or NUMBA_CACHE_DIR), so only the first run compiles.
+
+Random numbers come from the numba random state, that step reseeds from the
+seed it gets, so steps are reproducible, but not the same as the Fish engine draws.
+"""
+from math import atan2, sin, cos, sqrt, acos, pi
+
+import numpy as np
+
+from arena import OBSTACLE_TOP_VECTOR, OBSTACLE_BOTTOM_VECTOR
+from shoal import UNDECIDED, TOP, BOTTOM, BLIND_BACK, VectorizedShoal
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAVE_JIT = numba is not None
+
+OBSTACLE_TOP_HEADING = atan2(OBSTACLE_TOP_VECTOR[1], OBSTACLE_TOP_VECTOR[0])
+OBSTACLE_BOTTOM_HEADING = atan2(OBSTACLE_BOTTOM_VECTOR[1], OBSTACLE_BOTTOM_VECTOR[0])
+
+
+def jit(func):
+    if numba is None:
+        return func
+
+    return numba.njit(cache=True)(func)
+
+
+@jit
+def normalize_angle(angle):
+    if angle > pi:
+        angle -= 2 * pi
+    elif angle < -pi:
+        angle += 2 * pi
+
+    return angle
+
+
+@jit
+def draw(mean, sd, low, upp):
+    """Truncated normal sample, like utils.TruncatedNormalSampler.draw"""
+    a = (low - mean) / sd
+    b = (upp - mean) / sd
+
+    z = 0.0
+    accepted = False
+    for _ in range(32):
+        z = np.random.standard_normal()
+        if a <= z <= b:
+            accepted = True
+            break
+
+    # narrow bounds far from the mean: uniform proposals,
+    # accepted with the normal density relative to it's maximum on [a, b]
+    if not accepted:
+        closest = min(max(0.0, a), b)
+        while True:
+            z = a + (b - a) * np.random.random()
+            if np.random.random() <= np.exp((closest * closest - z * z) / 2):
+                break
+
+    return min(max(mean + sd * z, low), upp)
+
+
+@jit
+def get_turning_angle(angle):
+    turning_angle = 0.51 * sin(angle + 0.01)
+    turning_angle = draw(turning_angle, 0.1, turning_angle - 0.4, turning_angle + 0.4)
+
+    return normalize_angle(turning_angle)
+
+
+@jit
+def get_turning_angle_for_neighbor(distance, angle, coefficient, interaction_distance,
+                                   half_turn_distance):
+    turning_angle = 0.0
+
+    if distance < interaction_distance:
+        turning_angle = get_turning_angle(angle)
+
+        # half strength if fish is far away
+        if distance > half_turn_distance:
+            turning_angle *= 0.5
+
+    return turning_angle * coefficient
+
+
+@jit
+def get_acceleration_for_neighbor(distance, angle, coefficient, interaction_distance,
+                                  strong_attraction_distance, attraction_min_distance,
+                                  repulsion_distance):
+    neighbor_in_front = 0 < angle < pi / 2 or -pi / 2 < angle < 0
+    acceleration = 0.0
+
+    # 1. Strong attraction
+    if attraction_min_distance < distance <= interaction_distance:
+        if neighbor_in_front:
+            if distance > strong_attraction_distance:
+                acceleration = draw(2, 0.25, 1.5, 2.5)
+            else:
+                acceleration = draw(1.5, 0.25, 0.5, 1.5)
+        else:
+            acceleration = draw(-1, 0.25, -1.5, -0.5)
+
+    # 2. Strong repulsion
+    elif distance < repulsion_distance:
+        if neighbor_in_front:
+            acceleration = draw(-1, 0.25, -1.5, -0.5)
+        else:
+            acceleration = draw(2, 0.25, 1.5, 2.5)
+
+    return acceleration * coefficient
+
+
+@jit
+def get_walls_acceleration(x, y, vx, vy, width, height, top_line, bottom_line):
+    distance = 15
+    edge_x = 0.0
+    edge_y = 0.0
+
+    # close to the left wall
+    if x - distance <= 0:
+        edge_x = 1.0
+
+    # close to the !top wall
+    if y - distance <= 0:
+        edge_y = -1.0
+    # close to the right wall
+    elif x + distance >= width:
+        edge_x = -1.0
+    # close to the !bottom wall
+    elif y + distance >= height:
+        edge_y = 1.0
+
+    # obstacle has priority over the walls
+    if abs(top_line[0] * x + top_line[1] * y + top_line[2]) < distance:
+        edge_x, edge_y = 0.35, -0.94
+    if abs(bottom_line[0] * x + bottom_line[1] * y + bottom_line[2]) < distance:
+        edge_x, edge_y = 0.35, 0.94
+
+    if edge_x == 0 and edge_y == 0:
+        return 0.0
+
+    cosine = (edge_x * vx + edge_y * vy) / (sqrt(edge_x ** 2 + edge_y ** 2) * sqrt(vx ** 2 + vy ** 2))
+    angle = acos(min(max(cosine, -1.0), 1.0))
+
+    # is in "escaping the wall" mode
+    if pi / 2 - pi / 6 < angle < pi / 2 + pi / 6:
+        return draw(2, 0.5, 1, 3)
+
+    # approaching to the wall
+    if angle > pi / 2:
+        return draw(-0.5, 0.1, -1, 0)
+
+    return 0.0
+
+
+@jit
+def bounce_from_edge(x, y, vx, vy, width, height):
+    """Return new (x, y, vx, vy)"""
+    bounce_x = 0.0
+    bounce_y = 0.0
+    bounce_factor = draw(0.1, 0.05, 0.05, 0.15)
+    fish_heading = atan2(vy, vx)
+    corner_delta = 10
+
+    # bottom! wall
+    if y > height:
+        y = height
+        bounce_y -= bounce_factor
+        bounce_x += -1 if normalize_angle(-pi / 2 - fish_heading) > 0 else 1
+        if x - corner_delta < 0 or x + corner_delta > width:
+            bounce_x = -bounce_x
+
+    # right wall
+    if x > width:
+        x = width
+        bounce_x -= bounce_factor
+        bounce_y += 1 if normalize_angle(pi - fish_heading) > 0 else -1
+
+    # top! wall
+    if y < 0:
+        y = 0.0
+        bounce_y += bounce_factor
+        bounce_x += 1 if normalize_angle(pi / 2 - fish_heading) > 0 else -1
+        if x - corner_delta < 0 or x + corner_delta > width:
+            bounce_x = -bounce_x
+
+    # left wall
+    if x < 0:
+        x = 0.0
+        bounce_x += bounce_factor
+        bounce_y += -1 if normalize_angle(-fish_heading) > 0 else 1
+
+    # bounce if there is edge vector
+    if bounce_x != 0 or bounce_y != 0:
+        fish_speed = sqrt(vx ** 2 + vy ** 2)
+        bounce_heading = atan2(bounce_y, bounce_x)
+        vx = fish_speed * cos(bounce_heading)
+        vy = fish_speed * sin(bounce_heading)
+
+    return x, y, vx, vy
+
+
+@jit
+def bounce_from_obstacle(x, y, vx, vy, top_slope, top_intercept, bottom_slope, bottom_intercept):
+    """Return new (y, vx, vy)"""
+    y_top = top_slope * x + top_intercept
+    y_bottom = bottom_slope * x + bottom_intercept
+
+    if not y_top < y < y_bottom:
+        return y, vx, vy
+
+    fish_heading = atan2(vy, vx)
+    from_top = y - y_top < y_bottom - y
+    bounce_factor_angle = draw(0.1, 0.05, 0.08, 0.2)
+
+    obstacle_heading = OBSTACLE_TOP_HEADING if from_top else OBSTACLE_BOTTOM_HEADING
+    # bounce left if angle is positive, right if it is negative
+    if normalize_angle(obstacle_heading - fish_heading) > 0:
+        bounce_heading = obstacle_heading - pi / 2 + bounce_factor_angle
+    else:
+        bounce_heading = obstacle_heading + pi / 2 - bounce_factor_angle
+
+    fish_speed = sqrt(vx ** 2 + vy ** 2)
+    return y_top if from_top else y_bottom, fish_speed * cos(bounce_heading), \
+        fish_speed * sin(bounce_heading)
+
+
+@jit
+def shoal_step(position, velocity, replica, present, decision, reached, frozen, seed,
+               width, height, shaded_area_x, decision_x, follow_refugia_force,
+               freeze_x, drop_arrived, top_line, bottom_line,
+               top_slope, top_intercept, bottom_slope, bottom_intercept,
+               second_neighbor_turn_coefficient, second_neighbor_accelerate_coefficient,
+               max_speed, interaction_distance, half_turn_distance, strong_attraction_distance,
+               attraction_min_distance, repulsion_distance):
+    """Update all the agents of one shoal in place, fish by fish"""
+    np.random.seed(seed)
+    agents = len(position)
+    # neighbors further than this have no effect
+    reach = max(interaction_distance, repulsion_distance)
+
+    for i in range(agents):
+        if not present[i] or frozen[i] or reached[i]:
+            continue
+
+        x, y = position[i, 0], position[i, 1]
+        vx, vy = velocity[i, 0], velocity[i, 1]
+
+        if replica[i]:
+            fish_speed = sqrt(vx ** 2 + vy ** 2)
+            acceleration = draw(-0.24 * fish_speed + 1.54, 0.3, -10, 20)
+            vx += vx * acceleration / fish_speed
+            vy += vy * acceleration / fish_speed
+            velocity[i, 0], velocity[i, 1] = vx, vy
+            position[i, 0], position[i, 1] = x + vx, y + vy
+            continue
+
+        # validate if fish crossed decision line the first time
+        if decision[i] == UNDECIDED and x < decision_x:
+            decision[i] = TOP if y < height / 2 else BOTTOM
+
+        # put fish inside the shaded area
+        if x < shaded_area_x:
+            reached[i] = True
+            velocity[i, 0], velocity[i, 1] = 0.0, 0.0
+            position[i, 0] = 10.0
+            position[i, 1] = 10.0 if y < height / 2 else height - 10.0
+            continue
+
+        # two closest visible neighbors
+        fish_heading = atan2(vy, vx)
+        first, second = -1, -1
+        first_distance, second_distance = np.inf, np.inf
+        for j in range(agents):
+            if j == i or not present[j] or frozen[j] or drop_arrived and reached[j]:
+                continue
+
+            dx = position[j, 0] - x
+            dy = position[j, 1] - y
+            distance = sqrt(dx ** 2 + dy ** 2)
+            if distance > reach or distance >= second_distance:
+                continue
+
+            angle = normalize_angle(atan2(dy, dx) - fish_heading)
+            if -pi + BLIND_BACK < angle < pi - BLIND_BACK:
+                if distance < first_distance:
+                    second, second_distance = first, first_distance
+                    first, first_distance = j, distance
+                else:
+                    second, second_distance = j, distance
+
+        fish_speed = sqrt(vx ** 2 + vy ** 2)
+        standard_acceleration = draw(-0.24 * fish_speed + 1.54, 0.3, -10, 20)
+
+        # get turning angle
+        turning_angle = 0.0
+        for neighbor, distance, coefficient in ((first, first_distance, 1.0),
+                                                (second, second_distance,
+                                                 second_neighbor_turn_coefficient)):
+            if neighbor >= 0:
+                angle = normalize_angle(atan2(position[neighbor, 1] - y, position[neighbor, 0] - x)
+                                        - fish_heading)
+                turning_angle += get_turning_angle_for_neighbor(
+                    distance, angle, coefficient, interaction_distance, half_turn_distance)
+
+        if follow_refugia_force:
+            # angle for left wall direction
+            border_y = 80.0 if y < 400 else 720.0
+            angle = normalize_angle(atan2(border_y - y, -x) - fish_heading)
+            turning_angle += get_turning_angle(angle) * follow_refugia_force
+
+        # if there are no neighbors, turn a little bit randomly
+        elif turning_angle == 0:
+            turning_angle = draw(0, 0.4, -10, 10)
+
+        rotated_x = vx * cos(turning_angle) - vy * sin(turning_angle)
+        vy = vx * sin(turning_angle) + vy * cos(turning_angle)
+        vx = rotated_x
+
+        # neighbor acceleration uses the direction after turning
+        fish_heading = atan2(vy, vx)
+        neighbor_acceleration = 0.0
+        for neighbor, distance, coefficient in ((first, first_distance, 1.0),
+                                                (second, second_distance,
+                                                 second_neighbor_accelerate_coefficient)):
+            if neighbor >= 0:
+                angle = normalize_angle(atan2(position[neighbor, 1] - y, position[neighbor, 0] - x)
+                                        - fish_heading)
+                neighbor_acceleration += get_acceleration_for_neighbor(
+                    distance, angle, coefficient, interaction_distance,
+                    strong_attraction_distance, attraction_min_distance, repulsion_distance)
+
+        walls_acceleration = get_walls_acceleration(x, y, vx, vy, width, height,
+                                                    top_line, bottom_line)
+
+        acceleration = standard_acceleration + neighbor_acceleration + walls_acceleration
+        fish_speed = sqrt(vx ** 2 + vy ** 2)
+        vx += vx * acceleration / fish_speed
+        vy += vy * acceleration / fish_speed
+
+        # validate, that velocity has not passed the limit
+        fish_speed = sqrt(vx ** 2 + vy ** 2)
+        if fish_speed > max_speed:
+            vx *= max_speed / fish_speed
+            vy *= max_speed / fish_speed
+
+        x, y, vx, vy = bounce_from_edge(x + vx, y + vy, vx, vy, width, height)
+        y, vx, vy = bounce_from_obstacle(x, y, vx, vy, top_slope, top_intercept,
+                                         bottom_slope, bottom_intercept)
+
+        position[i, 0], position[i, 1] = x, y
+        velocity[i, 0], velocity[i, 1] = vx, vy
+
+    # replicas, that can't be neighbors anymore, are not updated
+    for i in range(agents):
+        if present[i] and replica[i] and position[i, 0] < freeze_x:
+            frozen[i] = True
+
+
+class JitShoal(VectorizedShoal):
+    """VectorizedShoal updated with the compiled shoal_step, used by Simulation(engine='jit')"""
+
+    def update(self, profiler=None):
+        arena = self.arena
+        shoal_step(self.position[0], self.velocity[0], self.replica[0], self.present[0],
+                   self.decision[0], self.reached_shaded_area[0], self.frozen[0],
+                   int(self.rng.integers(2 ** 32)),
+                   float(self.width), float(self.height), float(self.shaded_area_x),
+                   float(self.decision_x), float(self.follow_refugia_force[0]),
+                   float(self.freeze_x), bool(self.drop_arrived),
+                   np.array(arena.top_line), np.array(arena.bottom_line),
+                   arena.top_slope, arena.top_intercept, arena.bottom_slope, arena.bottom_intercept,
+                   float(self.second_neighbor_turn_coefficient),
+                   float(self.second_neighbor_accelerate_coefficient), float(self.max_speed),
+                   float(self.interaction_distance), float(self.half_turn_distance),
+                   float(self.strong_attraction_distance), float(self.attraction_min_distance),
+                   float(self.repulsion_distance))
+
+        if profiler:
+            profiler.lap('jit step')
@@ -0,0 +1,93 @@
+import json
+import logging
+import sys
+import time
+
+logger = logging.getLogger('fish_decision_making')
+logger.addHandler(logging.NullHandler())
+
+# verbosity -> logging level
+LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the structured summary of the record if it has one"""
+
+    def format(self, record):
+        data = {'time': record.created, 'level': record.levelname, 'message': record.getMessage()}
+        summary = getattr(record, 'summary', None)
+        if summary is not None:
+            data['summary'] = summary
+
+        return json.dumps(data)
+
+
+def configure_logging(verbosity=1, json_format=False, stream=sys.stderr):
+    """
+    verbosity: 0 - warnings only, 1 - progress and summaries, 2 - every decision of every fish
+    json_format: write records as JSON lines instead of plain text
+    """
+    handler = logging.StreamHandler(stream)
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+
+    for h in list(logger.handlers):
+        if not isinstance(h, logging.NullHandler):
+            logger.removeHandler(h)
+
+    logger.addHandler(handler)
+    logger.setLevel(LEVELS[min(max(verbosity, 0), 2)])
+
+
+def steps_per_second(steps, seconds):
+    return round(steps / seconds, 1) if seconds > 0 else None
+
+
+def log_summary(message, **summary):
+    """Log a structured record, e.g. the result of a shoal"""
+    if logger.isEnabledFor(logging.INFO):
+        details = ', '.join(f'{k}: {v}' for k, v in summary.items())
+        logger.info('%s (%s)', message, details, extra={'summary': summary})
+
+
+class Progress:
+    """
+    Rate-limited progress of a long loop: logs done items, items per second,
+    simulation steps per second (if steps are counted) and ETA at most once every
+    interval seconds
+    """
+
+    def __init__(self, total=None, unit='shoals', interval=5.0):
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.done = 0
+        self.steps = 0
+        self.start = self.last = time.time()
+
+    def update(self, n=1, steps=0):
+        """n: finished items, steps: simulation steps made since the last update"""
+        self.done += n
+        self.steps += steps
+        now = time.time()
+
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            self.report(now)
+
+    def report(self, now=None):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
+        elapsed = (now or time.time()) - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        steps = f', {self.steps / elapsed:.1f} steps/s' if self.steps and elapsed > 0 else ''
+
+        if self.total:
+            eta = (self.total - self.done) / rate if rate else float('inf')
+            logger.info('%s/%s %s, %.1f %s/s%s, ETA %.0fs',
+                        self.done, self.total, self.unit, rate, self.unit, steps, eta)
+        else:
+            logger.info('%s %s, %.1f %s/s%s', self.done, self.unit, rate, self.unit, steps)
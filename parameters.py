@@ -0,0 +1,34 @@
+# behavioral constants of the model,
+# Simulation(parameters={...}) changes them for one simulation
+DEFAULT_PARAMETERS = dict(
+    # how much the second closest neighbor turns and accelerates the fish
+    second_neighbor_turn_coefficient=0.2,
+    second_neighbor_accelerate_coefficient=0.2,
+    max_speed=17,
+    # neighbors closer than this turn and attract the fish
+    interaction_distance=100,
+    # neighbors further than this turn the fish at half strength
+    half_turn_distance=50,
+    # neighbors in front further than this make the fish accelerate stronger
+    strong_attraction_distance=25,
+    # neighbors closer than this don't attract the fish
+    attraction_min_distance=10,
+    # neighbors closer than this repel the fish
+    repulsion_distance=6,
+)
+
+
+def get_parameters(parameters=None):
+    """DEFAULT_PARAMETERS updated with parameters"""
+    parameters = parameters or {}
+    unknown = set(parameters) - set(DEFAULT_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown parameters: {", ".join(sorted(unknown))}')
+
+    return dict(DEFAULT_PARAMETERS, **parameters)
+
+
+def changed_parameters(parameters=None):
+    """Only the parameters, that differ from DEFAULT_PARAMETERS"""
+    return {name: value for name, value in get_parameters(parameters).items()
+            if value != DEFAULT_PARAMETERS[name]}
@@ -1,7 +1,15 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 from experimental_setups import SETUPS
-from hypothesis_testing import distribution_significance
+from hypothesis_testing import null_ks_tests, verbose_significance, as_cells
+from results_data import frequencies_original
+
+# group sizes of the columns of results_data.frequencies_original
+OBSERVED_GROUP_SIZES = [2, 4, 8]
 
 
 def plot_histogram(ax, frequencies, title, bins_n=6, original_frequencies=None):
@@ -25,18 +33,28 @@ def plot_histogram(ax, frequencies, title, bins_n=6, original_frequencies=None):
     ax.set_title(title)
 
 
-def plot_histogram_for_setup(replicas_bottom, replicas_top, setup_frequencies_data,
-                             original_frequencies_data, group_sizes=[2, 4, 8]):
-    """ plot histogram for one setup """
-    fig, ax = plt.subplots(1, 3, constrained_layout=True)
+def draw_histograms_for_setup(fig, replicas_bottom, replicas_top, setup_frequencies_data,
+                              original_frequencies_data, group_sizes=[2, 4, 8]):
+    """ draw histograms of all the group sizes of one setup to fig """
+    ax = fig.subplots(1, len(group_sizes), squeeze=False)[0]
 
-    # plotting histogram apart as it seams to consume memory and crash
     for i, group_size in enumerate(group_sizes):
         plot_histogram(ax[i],
                        setup_frequencies_data[i],
                        f'{replicas_bottom}:{replicas_top}, group size {group_size}',
                        original_frequencies=original_frequencies_data[i])
 
+
+def plot_histogram_for_setup(replicas_bottom, replicas_top, setup_frequencies_data,
+                             original_frequencies_data, group_sizes=[2, 4, 8]):
+    """ plot histogram for one setup """
+    fig = plt.figure(constrained_layout=True)
+
+    # plotting histogram apart as it seams to consume memory and crash
+    # (render_figures writes them to files instead)
+    draw_histograms_for_setup(fig, replicas_bottom, replicas_top, setup_frequencies_data,
+                              original_frequencies_data, group_sizes)
+
     fig.show()
 
 
@@ -47,14 +65,16 @@ def plot_histograms_for_set(experiments_data, original_data):
                                  i], original_data[i])
 
 
-def group_plot(group_data, group_size):
-    fig, ax = plt.subplots(1, 1, constrained_layout=True)
+def draw_group_plot(fig, group_data, group_size):
+    """ draw mean proportions of all the setups of one group size to fig """
+    ax = fig.subplots(1, 1)
 
     rows = group_data.shape[0]
     # calculate mean by row (sum columns or each row)
     # = get mean data for each setup (e.g. top 1, bottom 1)
-    mean = np.mean(group_data, axis=1)
-    std = np.std(group_data, axis=1)
+    # (rows can be padded with nan)
+    mean = np.nanmean(group_data, axis=1)
+    std = np.nanstd(group_data, axis=1)
 
     ax.scatter(range(rows), mean, color='royalblue')
 
@@ -62,11 +82,14 @@ def group_plot(group_data, group_size):
                 fmt='none', lw=1.2, elinewidth=1.4, capsize=2, markeredgewidth=1.4,
                 color='royalblue')
 
+    # random null hypothesis tests of all the rows at once
+    _, p_values = null_ks_tests(group_data, group_size)
+
     max_y = -np.inf
     min_y = np.inf
     for i in range(rows):
         bottom, top = SETUPS[i]
-        significance = distribution_significance(group_data[i], group_size)
+        significance = verbose_significance(p_values[i])
         # height = rectangle.get_height()
         x = i
         y = mean[i] + std[i] + 0.01
@@ -75,14 +98,14 @@ def group_plot(group_data, group_size):
         min_y = bottom if bottom < min_y else min_y
 
         # up - random null hypothesis rejection significance 
-        plt.text(x, y + 0.05, significance, ha='center', va='bottom')
+        ax.text(x, y + 0.05, significance, ha='center', va='bottom')
         # down - follow the replica in proportion hypothesis rejection significance
-        # plt.text(x, y, sign_follow, ha='center', va='bottom')
+        # ax.text(x, y, sign_follow, ha='center', va='bottom')
 
     xticks = [f'{s[0]}:{s[1]}' for s in SETUPS]
-    print(xticks)
 
-    ax.set_xticklabels([''] + xticks)
+    ax.set_xticks(range(rows))
+    ax.set_xticklabels(xticks)
     ax.set_yticks([0, 0.25, 0.5, 0.75, 1])
     ax.set_xlabel('Replicas going left:right')
     ax.set_ylabel('Proportion going right')
@@ -91,9 +114,98 @@ def group_plot(group_data, group_size):
 
     ax.set_title(f'Group size {group_size}')
 
+
+def group_plot(group_data, group_size):
+    fig = plt.figure(constrained_layout=True)
+
+    draw_group_plot(fig, group_data, group_size)
+
     fig.show()
 
 
 def groups_plots(experiments_data, group_sizes=[2, 4, 8]):
     for i, group_size in enumerate(group_sizes):
         group_plot(experiments_data[:, i], group_size)
+
+
+def render_figure(job):
+    """
+    Draw one figure of render_figures to a file, in a worker process.
+    matplotlib.figure.Figure is not managed by pyplot, so no window is opened,
+    it's rendered by the Agg canvas and it's memory is freed right after it's saved
+    """
+    kind, path, arguments = job
+    fig = Figure(constrained_layout=True, dpi=arguments.pop('dpi'))
+
+    if kind == 'histograms':
+        draw_histograms_for_setup(fig, **arguments)
+    else:
+        draw_group_plot(fig, **arguments)
+
+    fig.savefig(path)
+    fig.clear()
+
+    return path
+
+
+def render_figures(experiments_data, directory='figures', original_data=None,
+                   group_sizes=[2, 4, 8], workers=None, image_format='png', dpi=100):
+    """
+    Write the histograms of every setup and the plot of every group size
+    (plot_histograms_for_set and groups_plots) to files in directory, without
+    showing them, rendered in a pool of %workers processes (all the cpus by default).
+    experiments_data: (setups, group sizes, shoals) proportions, e.g. run_set results,
+    cells with less shoals are fine
+    original_data: observed proportions to show with the histograms, (setups,
+    OBSERVED_GROUP_SIZES, shoals) like results_data.frequencies_original (the default)
+    Returns paths of the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    data = as_cells(experiments_data)
+    if original_data is None:
+        original_data = frequencies_original
+
+    jobs = []
+    for i, (replicas_bottom, replicas_top) in enumerate(SETUPS):
+        # histograms of the shoals, that are there
+        setup_data = [cell[~np.isnan(cell)] for cell in data[i]]
+        # observed data of the same group sizes, if there is
+        setup_original = [original_data[i][OBSERVED_GROUP_SIZES.index(group_size)]
+                          if group_size in OBSERVED_GROUP_SIZES else None
+                          for group_size in group_sizes]
+        jobs.append(('histograms',
+                     os.path.join(directory, f'histograms_{replicas_bottom}_{replicas_top}.{image_format}'),
+                     dict(replicas_bottom=replicas_bottom, replicas_top=replicas_top,
+                          setup_frequencies_data=setup_data,
+                          original_frequencies_data=setup_original, group_sizes=group_sizes,
+                          dpi=dpi)))
+
+    for i, group_size in enumerate(group_sizes):
+        jobs.append(('group', os.path.join(directory, f'group_{group_size}.{image_format}'),
+                     dict(group_data=data[:, i], group_size=group_size, dpi=dpi)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_figure, jobs))
+
+
+if __name__ == '__main__':
+    import argparse
+    from batch import read_batch
+
+    parser = argparse.ArgumentParser(description='write the figures of a batch.py output to files')
+    parser.add_argument("input", help="run_batch output, jsonl or csv")
+    parser.add_argument("-d", "--directory", dest="directory", default='figures',
+                        help="directory to write the figures to (default = figures)")
+    parser.add_argument("-g", "--group-sizes", dest="group_sizes", nargs='+', type=int,
+                        default=[2, 4, 8], help="group sizes (default = 2 4 8)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="number of processes to render figures in")
+    parser.add_argument("--format", dest="image_format", default='png',
+                        help="image format, e.g. png, pdf, svg (default = png)")
+    parser.add_argument("--dpi", dest="dpi", type=int, default=100, help="(default = 100)")
+    args = parser.parse_args()
+
+    data = read_batch(args.input, group_sizes=args.group_sizes)
+    for path in render_figures(data, directory=args.directory, group_sizes=args.group_sizes,
+                               workers=args.workers, image_format=args.image_format, dpi=args.dpi):
+        print(path)
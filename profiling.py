@@ -0,0 +1,95 @@
+import time
+
+# phases of a step, in the order they happen
+PHASES = ['neighbor search', 'standard acceleration', 'turning', 'neighbor acceleration',
+          'wall acceleration', 'movement', 'edge bounce', 'obstacle bounce',
+          'decision bookkeeping', 'replicas']
+
+
+class Profiler:
+    """
+    Cumulative time, calls and random draws per phase of the simulation step
+
+    The step is timed with laps: lap(phase) adds everything since the previous
+    lap to phase, so phases never overlap and add up to the profiled steps.
+    Only every %every-th step is profiled, on the other steps the simulation
+    only checks that profiler is None, so it can stay on in long sweeps.
+
+        profiler = Profiler(every=10)
+        headless_simulation(fishes=8, profiler=profiler)
+        print(profiler.format_report())
+    """
+
+    def __init__(self, every=1, sampler=None):
+        """
+        every: profile every %every-th step
+        sampler: utils.TruncatedNormalSampler to count draws of, Simulation sets it's own
+        """
+        self.every = every
+        self.sampler = sampler
+        self.steps = 0
+        self.profiled_steps = 0
+        # phase -> [seconds, calls, draws]
+        self.phases = {}
+        self.last = None
+        self.last_draws = 0
+
+    def step(self):
+        """Count a step, start the laps and return True if the step is profiled"""
+        self.steps += 1
+        if (self.steps - 1) % self.every:
+            return False
+
+        self.profiled_steps += 1
+        self.start()
+        return True
+
+    def get_draws(self):
+        return self.sampler.draws if self.sampler is not None else 0
+
+    def start(self):
+        self.last_draws = self.get_draws()
+        self.last = time.perf_counter()
+
+    def lap(self, phase):
+        """Add the time and draws since the previous lap to phase"""
+        now = time.perf_counter()
+        draws = self.get_draws()
+
+        record = self.phases.get(phase)
+        if record is None:
+            record = self.phases[phase] = [0.0, 0, 0]
+        record[0] += now - self.last
+        record[1] += 1
+        record[2] += draws - self.last_draws
+
+        self.last_draws = draws
+        # don't count the profiler itself
+        self.last = time.perf_counter()
+
+    def report(self):
+        """Dict with the steps and time, calls, draws and share of the time of every phase"""
+        total = sum(seconds for seconds, _, _ in self.phases.values())
+        order = {phase: i for i, phase in enumerate(PHASES)}
+
+        phases = {}
+        for phase in sorted(self.phases, key=lambda p: order.get(p, len(order))):
+            seconds, calls, draws = self.phases[phase]
+            phases[phase] = dict(time=seconds, calls=calls, draws=draws,
+                                 time_per_call=seconds / calls if calls else 0.0,
+                                 share=seconds / total if total else 0.0)
+
+        return dict(steps=self.steps, profiled_steps=self.profiled_steps, time=total,
+                    phases=phases)
+
+    def format_report(self):
+        report = self.report()
+        lines = [f'{report["profiled_steps"]} of {report["steps"]} steps profiled, '
+                 f'{report["time"] * 1e3:.1f} ms',
+                 f'{"phase":<24}{"ms":>10}{"share":>8}{"calls":>10}{"us/call":>10}{"draws":>10}']
+
+        for phase, p in report['phases'].items():
+            lines.append(f'{phase:<24}{p["time"] * 1e3:>10.2f}{p["share"]:>8.1%}{p["calls"]:>10}'
+                         f'{p["time_per_call"] * 1e6:>10.2f}{p["draws"]:>10}')
+
+        return '\n'.join(lines)
@@ -0,0 +1,163 @@
+import json
+import os
+
+import numpy as np
+
+from shoal import UNDECIDED, TOP, BOTTOM
+
+# decisions of Fish objects -> decision codes of shoal.ShoalEnsemble
+DECISION_CODES = {None: UNDECIDED, 'top': TOP, 'bottom': BOTTOM}
+
+# recorded arrays: name -> (dtype, shape of one agent)
+FIELDS = {'positions': (np.float32, (2,)), 'velocities': (np.float32, (2,)),
+          'decisions': (np.int8, ())}
+
+
+class TrajectoryRecorder:
+    """
+    Streams the state of every agent after every step to chunked .npy files
+
+    Every chunk_steps steps a new chunk of each field is preallocated with
+    np.lib.format.open_memmap and filled step by step, so the history never
+    stays in memory. meta.json says how many steps of the last chunk are filled.
+
+        recorder = TrajectoryRecorder('trajectories/shoal')
+        headless_simulation(fishes=8, seed=1, recorder=recorder)
+        positions = TrajectoryReader('trajectories/shoal').get('positions')
+    """
+
+    def __init__(self, directory, chunk_steps=1024):
+        self.directory = directory
+        self.chunk_steps = chunk_steps
+        self.steps = 0
+        self.agents = None
+        self.chunks = {}
+        self.meta = {}
+
+    def start(self, simulation):
+        """Called by Simulation, saves what is needed to replay the steps"""
+        os.makedirs(self.directory, exist_ok=True)
+        replicas = simulation.get_replicas()
+
+        self.steps = 0
+        self.agents = len(replicas)
+        self.chunks = {}
+        self.meta = dict(agents=self.agents, chunk_steps=self.chunk_steps, steps=0,
+                         fields=list(FIELDS), replicas=replicas.tolist(),
+                         fishes=simulation.fishes, engine=simulation.engine,
+                         free_run=simulation.free_run,
+                         replicas_coordinates=simulation.replicas_coordinates)
+        self.write_meta()
+
+    def get_path(self, field, chunk):
+        return os.path.join(self.directory, f'{field}_{chunk:05d}.npy')
+
+    def get_chunk(self, field):
+        chunk, i = divmod(self.steps, self.chunk_steps)
+
+        if i == 0:
+            if field in self.chunks:
+                self.chunks[field].flush()
+                # so full chunks can be read even if the simulation is killed
+                self.write_meta()
+            dtype, shape = FIELDS[field]
+            self.chunks[field] = np.lib.format.open_memmap(
+                self.get_path(field, chunk), mode='w+', dtype=dtype,
+                shape=(self.chunk_steps, self.agents) + shape)
+
+        return self.chunks[field]
+
+    def record(self, simulation):
+        """Write the state of the simulation after a step"""
+        i = self.steps % self.chunk_steps
+        self.get_chunk('positions')[i] = simulation.get_positions()
+        self.get_chunk('velocities')[i] = simulation.get_velocities()
+        self.get_chunk('decisions')[i] = simulation.get_decisions()
+        self.steps += 1
+
+    def write_meta(self):
+        self.meta['steps'] = self.steps
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def close(self):
+        for chunk in self.chunks.values():
+            chunk.flush()
+        self.chunks = {}
+        self.write_meta()
+
+
+class TrajectoryReader:
+    """Lazy access to the steps saved by TrajectoryRecorder, chunks are memory-mapped"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.steps = self.meta['steps']
+        self.chunk_steps = self.meta['chunk_steps']
+        self.replicas = np.array(self.meta['replicas'], dtype=bool)
+        self.chunks = {}
+
+    def __len__(self):
+        return self.steps
+
+    def get_chunk(self, field, chunk):
+        key = (field, chunk)
+        if key not in self.chunks:
+            self.chunks[key] = np.load(os.path.join(self.directory, f'{field}_{chunk:05d}.npy'),
+                                       mmap_mode='r')
+
+        return self.chunks[key]
+
+    def get_step(self, field, step):
+        """(agents, ...) array of field after step (0 is after the first step), no copy"""
+        if not -self.steps <= step < self.steps:
+            raise IndexError(f'step {step} out of {self.steps} recorded steps')
+
+        chunk, i = divmod(step % self.steps, self.chunk_steps)
+        return self.get_chunk(field, chunk)[i]
+
+    def iter_chunks(self, field):
+        """Yield memory-mapped (steps, agents, ...) chunks of field, the last one cut to the steps"""
+        for start in range(0, self.steps, self.chunk_steps):
+            chunk = self.get_chunk(field, start // self.chunk_steps)
+            yield chunk[:min(self.chunk_steps, self.steps - start)]
+
+    def get(self, field, start=0, stop=None):
+        """(steps, agents, ...) array of field for steps start:stop, copied from the chunks"""
+        stop = self.steps if stop is None else min(stop, self.steps)
+        if start >= stop:
+            dtype, shape = FIELDS[field]
+            return np.empty((0, self.meta['agents']) + shape, dtype=dtype)
+
+        parts = []
+        for chunk in range(start // self.chunk_steps, (stop - 1) // self.chunk_steps + 1):
+            offset = chunk * self.chunk_steps
+            parts.append(self.get_chunk(field, chunk)[max(start - offset, 0):stop - offset])
+
+        return np.concatenate(parts)
+
+
+class Replay:
+    """Draws the recorded steps with p5 on the arena of simulation, one step per frame"""
+
+    def __init__(self, reader, simulation):
+        self.reader = reader
+        self.simulation = simulation
+        # draw the replica lines of the recorded simulation
+        simulation.replicas_coordinates = [tuple(c) for c in reader.meta['replicas_coordinates']]
+        self.step = 0
+
+    def run_step(self):
+        from p5 import stroke, circle
+
+        self.simulation.draw_objects()
+
+        stroke(255)
+        for x, y in self.reader.get_step('positions', self.step):
+            circle((float(x), float(y)), radius=10)
+
+        # stay on the last step when the replay is over
+        self.step = min(self.step + 1, len(self.reader) - 1)
@@ -0,0 +1,552 @@
+import numpy as np
+
+from arena import Arena, OBSTACLE_TOP_VECTOR, OBSTACLE_BOTTOM_VECTOR, distance_to_line
+from parameters import get_parameters
+from utils import TruncatedNormalSampler
+
+# decision codes, stored in ShoalEnsemble.decision
+UNDECIDED = 0
+TOP = 1
+BOTTOM = 2
+
+# fish can't see neighbors in the cone right behind it
+BLIND_BACK = np.pi / 15
+
+
+def normalize_angle(angle):
+    """Same as Fish.normalize_angle, for arrays of angles"""
+    angle = np.where(angle > np.pi, angle - 2 * np.pi, angle)
+    return np.where(angle < -np.pi, angle + 2 * np.pi, angle)
+
+
+def heading(velocity):
+    return np.arctan2(velocity[..., 1], velocity[..., 0])
+
+
+def speed(velocity):
+    return np.hypot(velocity[..., 0], velocity[..., 1])
+
+
+def rotate(velocity, theta):
+    cos = np.cos(theta)
+    sin = np.sin(theta)
+    x = velocity[..., 0] * cos - velocity[..., 1] * sin
+    y = velocity[..., 0] * sin + velocity[..., 1] * cos
+    return np.stack((x, y), axis=-1)
+
+
+def with_heading(velocity, theta):
+    """Turn velocity to the direction theta, keeping the speed"""
+    return speed(velocity)[..., None] * np.stack((np.cos(theta), np.sin(theta)), axis=-1)
+
+
+class ShoalEnsemble:
+    """
+    Structure of arrays version of many independent shoals of Fish
+
+    Keeps positions and velocities of all the fishes and replicas in
+    (S, N, 2) arrays, S shoals of at most N agents, and applies the rules
+    of fish.Fish to all of them at once. In every shoal fishes come first,
+    replicas are after them, smaller shoals are padded with agents that
+    are not present. Fishes only see neighbors from their own shoal.
+
+    Unlike the Fish loop, where every fish already sees the new positions of
+    the fishes updated before it, all fishes here react to the positions at
+    the beginning of the step.
+    """
+
+    def __init__(self, shoals, width, height, shaded_area_x, decision_x,
+                 follow_refugia_force=None, rng=None, sampler=None, parameters=None):
+        """
+        shoals: list of (starting positions of fishes, replicas coordinates),
+        follow_refugia_force: one value for all the shoals or one per shoal,
+        rng: np.random.Generator or seed for all the random draws
+        parameters: dict of behavioral constants to change for all the shoals,
+        see parameters.DEFAULT_PARAMETERS
+        """
+        self.set_rng(rng, sampler)
+        self.width = width
+        self.height = height
+        self.arena = Arena(width, height)
+        self.shaded_area_x = shaded_area_x
+        self.decision_x = decision_x
+
+        follow_refugia_force = np.broadcast_to(np.asarray(follow_refugia_force, dtype=object),
+                                               len(shoals))
+        self.follow_refugia_force = np.array([f or 0 for f in follow_refugia_force], dtype=float)
+
+        # second_neighbor_turn_coefficient, max_speed, distance thresholds, ...
+        for name, value in get_parameters(parameters).items():
+            setattr(self, name, value)
+
+        # neighbors further than this have no effect
+        reach = max(self.interaction_distance, self.repulsion_distance)
+        # fishes that are not in the shaded area yet are never further left than this,
+        # so agents left of freeze_x can't be their neighbors anymore
+        active_min_x = shaded_area_x - self.max_speed
+        self.freeze_x = active_min_x - reach
+        # fishes in the shaded area (at x = 10) are too far from everyone, to be neighbors
+        self.drop_arrived = active_min_x - 10 > reach
+
+        agents = max([len(positions) + len(replicas) for positions, replicas in shoals] + [1])
+        self.position = np.zeros((len(shoals), agents, 2))
+        self.velocity = np.zeros((len(shoals), agents, 2))
+        self.replica = np.zeros((len(shoals), agents), dtype=bool)
+        self.present = np.zeros((len(shoals), agents), dtype=bool)
+
+        for i, (positions, replicas_coordinates) in enumerate(shoals):
+            fishes = len(positions)
+            replicas = len(replicas_coordinates)
+
+            self.position[i, :fishes] = np.asarray(positions, dtype=float).reshape(-1, 2)
+            # random initial speed
+            self.velocity[i, :fishes] = (self.rng.random((fishes, 2)) - 0.5) * 10
+
+            # replicas swim with speed 8 towards the end of their path
+            for j, (x, y, final_y) in enumerate(replicas_coordinates, start=fishes):
+                direction = np.array([-x, final_y - y])
+                direction = direction / speed(direction)
+                self.position[i, j] = x, y
+                self.velocity[i, j] = direction + direction * 8
+
+            self.replica[i, fishes:fishes + replicas] = True
+            self.present[i, :fishes + replicas] = True
+
+        self.fishes = np.sum(self.present & ~self.replica, axis=1)
+        self.decision = np.full(self.present.shape, UNDECIDED, dtype=np.int8)
+        self.reached_shaded_area = np.zeros(self.present.shape, dtype=bool)
+        # replicas left of freeze_x are not updated anymore
+        self.frozen = np.zeros(self.present.shape, dtype=bool)
+        # finished shoals are not updated anymore
+        self.finished = np.zeros(len(shoals), dtype=bool)
+
+    def set_rng(self, rng=None, sampler=None):
+        self.rng = np.random.default_rng(rng)
+        self.sampler = sampler if sampler is not None else TruncatedNormalSampler(self.rng)
+
+    @classmethod
+    def stack(cls, shoals, rng=None):
+        """
+        Join shoals (e.g. shoals of Simulation(engine='vectorized')) into one ensemble,
+        that draws from rng from now on, at least one shoal is needed
+        """
+        if not shoals:
+            raise ValueError('ShoalEnsemble.stack needs at least one shoal')
+
+        ensemble = cls.__new__(cls)
+        ensemble.__dict__.update(shoals[0].__dict__)
+        ensemble.set_rng(rng)
+
+        agents = max(shoal.position.shape[1] for shoal in shoals)
+
+        def pad(array):
+            padding = [(0, 0), (0, agents - array.shape[1])] + [(0, 0)] * (array.ndim - 2)
+            return np.pad(array, padding)
+
+        for name in ('position', 'velocity', 'replica', 'present', 'decision', 'reached_shaded_area',
+                     'frozen'):
+            setattr(ensemble, name, np.concatenate([pad(getattr(shoal, name)) for shoal in shoals]))
+
+        for name in ('follow_refugia_force', 'fishes', 'finished'):
+            setattr(ensemble, name, np.concatenate([getattr(shoal, name) for shoal in shoals]))
+
+        return ensemble
+
+    def __len__(self):
+        return len(self.position)
+
+    def update(self, profiler=None):
+        """profiler: profiling.Profiler to time the phases of the update with"""
+        running = self.present & ~self.finished[:, None]
+        active = running & ~self.replica & ~self.reached_shaded_area
+
+        # validate if fish crossed decision line the first time
+        crossed = active & (self.decision == UNDECIDED) & (self.position[..., 0] < self.decision_x)
+        self.decision[crossed] = np.where(self.position[crossed][:, 1] < self.height / 2, TOP, BOTTOM)
+
+        # put fishes that reached shaded area inside it
+        arrived = active & (self.position[..., 0] < self.shaded_area_x)
+        self.reached_shaded_area |= arrived
+        self.velocity[arrived] = 0
+        self.position[arrived] = np.stack((np.full(arrived.sum(), 10.),
+                                           np.where(self.position[arrived][:, 1] < self.height / 2,
+                                                    10, self.height - 10)), axis=-1)
+        active &= ~arrived
+
+        if profiler:
+            profiler.lap('decision bookkeeping')
+
+        if active.any():
+            self.update_fishes(active, profiler=profiler)
+
+        replicas = running & self.replica & ~self.frozen
+        if replicas.any():
+            self.update_replicas(replicas)
+            self.frozen |= replicas & (self.position[..., 0] < self.freeze_x)
+
+            if profiler:
+                profiler.lap('replicas')
+
+    def update_replicas(self, replicas):
+        velocity = self.velocity[replicas]
+        acceleration = self.get_standard_acceleration(velocity)
+        velocity = velocity + velocity * (acceleration / speed(velocity))[:, None]
+
+        self.velocity[replicas] = velocity
+        self.position[replicas] += velocity
+
+    def count_decisions(self):
+        """Return (all decided, top, bottom) arrays with a value per shoal"""
+        fishes = ~self.replica & self.present
+        top = np.sum(fishes & (self.decision == TOP), axis=1)
+        bottom = np.sum(fishes & (self.decision == BOTTOM), axis=1)
+
+        return top + bottom == self.fishes, top, bottom
+
+    def finish_decided(self):
+        """
+        Stop updating shoals, where all fishes have decided,
+        return indexes of the shoals that have just finished with their top and bottom counts
+        """
+        all_decided, top, bottom = self.count_decisions()
+        finished = np.flatnonzero(all_decided & ~self.finished)
+        self.finished[finished] = True
+
+        return finished, top[finished], bottom[finished]
+
+    def update_fishes(self, fishes, profiler=None):
+        """Update fishes selected with (S, N) mask"""
+        position = self.position[fishes]
+        velocity = self.velocity[fishes]
+        shoal_index, agent_index = np.nonzero(fishes)
+        follow_refugia_force = self.follow_refugia_force[shoal_index]
+
+        neighbors = self.get_closest_neighbors(shoal_index, agent_index)
+        (first_distance, first_direction), (second_distance, second_direction) = neighbors
+
+        if profiler:
+            profiler.lap('neighbor search')
+
+        standard_acceleration = self.get_standard_acceleration(velocity)
+
+        if profiler:
+            profiler.lap('standard acceleration')
+
+        # get turning angle
+        fish_heading = heading(velocity)
+        turning_angle = self.get_turning_angle_for_neighbor(
+            first_distance, normalize_angle(first_direction - fish_heading))
+        turning_angle += self.get_turning_angle_for_neighbor(
+            second_distance, normalize_angle(second_direction - fish_heading),
+            coefficient=self.second_neighbor_turn_coefficient)
+
+        follow_refugia = follow_refugia_force != 0
+        if follow_refugia.any():
+            # angle for left wall direction
+            border_y = np.where(position[follow_refugia, 1] < 400, 80, 720)
+            direction_to_border = np.arctan2(border_y - position[follow_refugia, 1],
+                                             -position[follow_refugia, 0])
+            angle = normalize_angle(direction_to_border - fish_heading[follow_refugia])
+            turning_angle[follow_refugia] += self.get_turning_angle(angle) * \
+                follow_refugia_force[follow_refugia]
+
+        # if there are no neighbors, turn a little bit randomly
+        lonely = ~follow_refugia & (turning_angle == 0)
+        turning_angle[lonely] = self.sampler.sample(0, 0.4, -10, 10, size=lonely.sum())
+
+        velocity = rotate(velocity, turning_angle)
+
+        if profiler:
+            profiler.lap('turning')
+
+        # neighbor acceleration uses the direction after turning
+        fish_heading = heading(velocity)
+        neighbor_acceleration = self.get_acceleration_for_neighbor(
+            first_distance, normalize_angle(first_direction - fish_heading))
+        neighbor_acceleration += self.get_acceleration_for_neighbor(
+            second_distance, normalize_angle(second_direction - fish_heading),
+            coefficient=self.second_neighbor_accelerate_coefficient)
+
+        if profiler:
+            profiler.lap('neighbor acceleration')
+
+        walls_acceleration = self.get_walls_acceleration(position, velocity)
+
+        if profiler:
+            profiler.lap('wall acceleration')
+
+        acceleration = standard_acceleration + neighbor_acceleration + walls_acceleration
+        velocity = velocity + velocity * (acceleration / speed(velocity))[:, None]
+
+        # validate, that velocity has not passed the limit
+        fish_speed = speed(velocity)
+        too_fast = fish_speed > self.max_speed
+        velocity[too_fast] *= (self.max_speed / fish_speed[too_fast])[:, None]
+
+        position = position + velocity
+
+        if profiler:
+            profiler.lap('movement')
+
+        position, velocity = self.bounce_from_edge(position, velocity)
+
+        if profiler:
+            profiler.lap('edge bounce')
+
+        position, velocity = self.bounce_from_obstacle(position, velocity)
+
+        self.position[fishes] = position
+        self.velocity[fishes] = velocity
+
+        if profiler:
+            profiler.lap('obstacle bounce')
+
+    def get_closest_neighbors(self, shoal_index, agent_index):
+        """
+        Return (distance, direction) of the first and the second closest
+        visible neighbor from the same shoal for every fish,
+        distance is inf when there is no such neighbor
+        """
+        rows = np.arange(len(shoal_index))
+
+        # only agents, that can still be neighbors of someone
+        candidates = self.present & ~self.frozen
+        if self.drop_arrived:
+            candidates &= ~self.reached_shaded_area
+        candidates = candidates[shoal_index]
+        columns = np.flatnonzero(candidates.any(axis=0))
+        column_index = np.zeros(self.present.shape[1], dtype=int)
+        column_index[columns] = np.arange(len(columns))
+
+        position = self.position[shoal_index]
+        if len(columns) < position.shape[1]:
+            position = position[:, columns]
+            candidates = candidates[:, columns]
+        to_neighbor = position - self.position[shoal_index, agent_index][:, None, :]
+        distance = speed(to_neighbor)
+        direction = heading(to_neighbor)
+
+        angle = normalize_angle(direction - heading(self.velocity[shoal_index, agent_index])[:, None])
+        visible = (angle < np.pi - BLIND_BACK) & (angle > -np.pi + BLIND_BACK)
+        visible &= candidates
+        # skip self!
+        visible[rows, column_index[agent_index]] = False
+
+        distance = np.where(visible, distance, np.inf)
+
+        if distance.shape[1] > 2:
+            closest = np.argpartition(distance, 1, axis=1)[:, :2]
+        else:
+            closest = np.broadcast_to(np.arange(distance.shape[1]), distance.shape)
+        closest_distance = distance[rows[:, None], closest]
+
+        # order the two candidates by distance
+        order = np.argsort(closest_distance, axis=1)
+        closest = np.take_along_axis(closest, order, axis=1)
+
+        neighbors = []
+        for k in range(2):
+            if k < closest.shape[1]:
+                neighbor_distance = distance[rows, closest[:, k]]
+                neighbor_direction = np.where(np.isfinite(neighbor_distance),
+                                              direction[rows, closest[:, k]], 0)
+            else:
+                neighbor_distance = np.full(len(rows), np.inf)
+                neighbor_direction = np.zeros(len(rows))
+            neighbors.append((neighbor_distance, neighbor_direction))
+
+        return neighbors
+
+    def get_standard_acceleration(self, velocity):
+        # standard acceleration depends on velocity (Fig. 2.D)
+        # as -0.24x + 1.54
+        standard_acceleration = -0.24 * speed(velocity) + 1.54
+        return self.sampler.sample(mean=standard_acceleration, sd=0.3, low=-10, upp=20)
+
+    def get_turning_angle(self, angle):
+        turning_angle = 0.51 * np.sin(angle + 0.01)
+        turning_angle = self.sampler.sample(mean=turning_angle, sd=0.1,
+                                           low=turning_angle - 0.4, upp=turning_angle + 0.4)
+        return normalize_angle(turning_angle)
+
+    def get_turning_angle_for_neighbor(self, distance, angle, coefficient=1.0):
+        turning_angle = np.zeros(len(distance))
+
+        close = distance < self.interaction_distance
+        turning_angle[close] = self.get_turning_angle(angle[close])
+
+        # half strength if fish is far away
+        turning_angle[close & (distance > self.half_turn_distance)] *= 0.5
+
+        return turning_angle * coefficient
+
+    def get_acceleration_for_neighbor(self, distance, angle, coefficient=1):
+        neighbor_in_front = (angle > 0) & (angle < np.pi / 2) | (angle < 0) & (angle > -np.pi / 2)
+
+        # 1. Strong attraction
+        attraction = (distance > self.attraction_min_distance) & (distance <= self.interaction_distance)
+        # 2. Strong repulsion
+        repulsion = distance < self.repulsion_distance
+
+        accelerate = attraction & neighbor_in_front & (distance > self.strong_attraction_distance) \
+            | repulsion & ~neighbor_in_front
+        accelerate_close = attraction & neighbor_in_front & \
+            (distance <= self.strong_attraction_distance)
+        decelerate = attraction & ~neighbor_in_front | repulsion & neighbor_in_front
+
+        # default acceleration is 0
+        acceleration = np.zeros(len(distance))
+        acceleration[accelerate] = self.sampler.sample(2, 0.25, 1.5, 2.5, size=accelerate.sum())
+        acceleration[accelerate_close] = self.sampler.sample(
+            1.5, 0.25, 0.5, 1.5, size=accelerate_close.sum())
+        acceleration[decelerate] = self.sampler.sample(-1, 0.25, -1.5, -0.5, size=decelerate.sum())
+
+        return acceleration * coefficient
+
+    def get_edge_vector(self, position, distance=15):
+        x = position[:, 0]
+        y = position[:, 1]
+        edge_vector = np.zeros_like(position)
+
+        # close to the left wall
+        edge_vector[x - distance <= 0, 0] = 1
+
+        # close to the !top wall
+        top = y - distance <= 0
+        edge_vector[top, 1] = -1
+
+        # close to the right wall
+        right = ~top & (x + distance >= self.width)
+        edge_vector[right, 0] = -1
+
+        # close to the !bottom wall
+        bottom = ~top & ~right & (y + distance >= self.height)
+        edge_vector[bottom, 1] = 1
+
+        # obstacle has priority over the walls
+        edge_vector[distance_to_line(self.arena.top_line, x, y) < distance] = OBSTACLE_TOP_VECTOR
+        edge_vector[distance_to_line(self.arena.bottom_line, x, y) < distance] = OBSTACLE_BOTTOM_VECTOR
+
+        return edge_vector
+
+    def get_walls_acceleration(self, position, velocity):
+        edge_vector = self.get_edge_vector(position, distance=15)
+        edge_magnitude = speed(edge_vector)
+        close_to_wall = edge_magnitude > 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            angle = np.arccos(np.sum(edge_vector * velocity, axis=1) /
+                              (edge_magnitude * speed(velocity)))
+
+        # is in "escaping the wall" mode
+        escaping = close_to_wall & (np.pi / 2 - np.pi / 6 < angle) & (angle < np.pi / 2 + np.pi / 6)
+        # approaching to the wall
+        approaching = close_to_wall & ~escaping & (angle > np.pi / 2)
+
+        walls_acceleration = np.zeros(len(position))
+        walls_acceleration[escaping] = self.sampler.sample(2, 0.5, 1, 3, size=escaping.sum())
+        walls_acceleration[approaching] = self.sampler.sample(
+            -0.5, 0.1, -1, 0, size=approaching.sum())
+
+        return walls_acceleration
+
+    def bounce_from_edge(self, position, velocity):
+        position = position.copy()
+        bounce_vector = np.zeros_like(position)
+        bounce_factor = self.sampler.sample(0.1, 0.05, 0.05, 0.15, size=len(position))
+        fish_heading = heading(velocity)
+        corner_delta = 10
+
+        def close_to_corner():
+            return (position[:, 0] - corner_delta < 0) | (position[:, 0] + corner_delta > self.width)
+
+        # bottom! wall
+        bottom = position[:, 1] > self.height
+        position[bottom, 1] = self.height
+        bounce_vector[bottom, 1] -= bounce_factor[bottom]
+        angle = normalize_angle(-np.pi / 2 - fish_heading)
+        bounce_vector[bottom, 0] += np.where(angle[bottom] > 0, -1, 1)
+        corner = bottom & close_to_corner()
+        bounce_vector[corner, 0] *= -1
+
+        # right wall
+        right = position[:, 0] > self.width
+        position[right, 0] = self.width
+        bounce_vector[right, 0] -= bounce_factor[right]
+        angle = normalize_angle(np.pi - fish_heading)
+        bounce_vector[right, 1] += np.where(angle[right] > 0, 1, -1)
+
+        # top! wall
+        top = position[:, 1] < 0
+        position[top, 1] = 0
+        bounce_vector[top, 1] += bounce_factor[top]
+        angle = normalize_angle(np.pi / 2 - fish_heading)
+        bounce_vector[top, 0] += np.where(angle[top] > 0, 1, -1)
+        corner = top & close_to_corner()
+        bounce_vector[corner, 0] *= -1
+
+        # left wall
+        left = position[:, 0] < 0
+        position[left, 0] = 0
+        bounce_vector[left, 0] += bounce_factor[left]
+        angle = normalize_angle(-fish_heading)
+        bounce_vector[left, 1] += np.where(angle[left] > 0, -1, 1)
+
+        # bounce if there is edge vector
+        bounce = speed(bounce_vector) > 0
+        velocity = velocity.copy()
+        velocity[bounce] = with_heading(velocity[bounce], heading(bounce_vector[bounce]))
+
+        return position, velocity
+
+    def bounce_from_obstacle(self, position, velocity):
+        x = position[:, 0]
+        y = position[:, 1]
+        y_top = self.arena.top_obstacle_y(x)
+        y_bottom = self.arena.bottom_obstacle_y(x)
+
+        inside = (y_top < y) & (y < y_bottom)
+        if not inside.any():
+            return position, velocity
+
+        fish_heading = heading(velocity[inside])
+        from_top = (y - y_top < y_bottom - y)[inside]
+        bounce_factor_angle = self.sampler.sample(0.1, 0.05, 0.08, 0.2, size=inside.sum())
+
+        obstacle_heading = np.where(from_top, heading(np.array(OBSTACLE_TOP_VECTOR)),
+                                    heading(np.array(OBSTACLE_BOTTOM_VECTOR)))
+        # bounce left if angle is positive, right if it is negative
+        bounce_left = normalize_angle(obstacle_heading - fish_heading) > 0
+        bounce_heading = np.where(bounce_left,
+                                  obstacle_heading - np.pi / 2 + bounce_factor_angle,
+                                  obstacle_heading + np.pi / 2 - bounce_factor_angle)
+
+        position = position.copy()
+        velocity = velocity.copy()
+        velocity[inside] = with_heading(velocity[inside], bounce_heading)
+        position[inside, 1] = np.where(from_top, y_top[inside], y_bottom[inside])
+
+        return position, velocity
+
+
+class VectorizedShoal(ShoalEnsemble):
+    """ShoalEnsemble with a single shoal, used by Simulation(engine='vectorized')"""
+
+    def __init__(self, positions, width, height, shaded_area_x, decision_x,
+                 replicas_coordinates=(), follow_refugia_force=None, rng=None, sampler=None,
+                 parameters=None):
+        super().__init__([(positions, replicas_coordinates)], width, height,
+                         shaded_area_x, decision_x, follow_refugia_force=follow_refugia_force,
+                         rng=rng, sampler=sampler, parameters=parameters)
+
+    def count_decisions(self):
+        all_decided, top, bottom = super().count_decisions()
+
+        return bool(all_decided[0]), int(top[0]), int(bottom[0])
+
+    def show(self):
+        from p5 import stroke, circle
+
+        stroke(255)
+        for x, y in self.position[self.present]:
+            circle((x, y), radius=10)
@@ -1,17 +1,75 @@
 import time
 import argparse
 import numpy as np
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from p5 import setup, draw, size, background, run, triangle, fill, rect, line, quad
-from fish import Fish
+from arena import Arena
+from fish import Fish, replica_path
+from shoal import ShoalEnsemble, VectorizedShoal
+from spatial import NeighborGrid
+from logs import logger, log_summary, steps_per_second, Progress
+from recorder import DECISION_CODES, TrajectoryReader, Replay
+from parameters import get_parameters
+from utils import TruncatedNormalSampler
+from vector import Vector
+
+
+def effective_engine(engine):
+    """
+    The engine, that Simulation(engine=engine) really uses ('fish' for 'jit' without numba),
+    to record with the results
+    """
+    if engine == 'jit':
+        # numba takes a while to import, only load it when needed
+        import kernels
+        if not kernels.HAVE_JIT:
+            return 'fish'
+
+    return engine
+
+
+def check_replica_seed(engine, replica_seed):
+    """Only the 'fish' engine draws replica paths, the others can't use replica_seed"""
+    if replica_seed is not None and engine != 'fish':
+        raise ValueError(f'replica_seed is only supported by the fish engine, not {engine!r}')
 
 
 class Simulation:
 
     def __init__(self, fishes=4, replicas_top=0, replicas_bottom=0, follow_refugia_force=None,
-                 free_run=False):
+                 free_run=False, engine='fish', seed=None, rng=None, profiler=None,
+                 recorder=None, parameters=None, replica_seed=None):
+        """
+        engine: 'fish' updates every Fish object one by one,
+        'vectorized' updates the whole shoal at once with shoal.VectorizedShoal,
+        'jit' updates fishes one by one like 'fish', in a compiled loop (kernels.shoal_step),
+        falls back to 'fish' if numba is not installed
+        seed: seed (int or np.random.SeedSequence) for the simulation random stream,
+        rng: np.random.Generator to use instead of seed
+        profiler: profiling.Profiler to collect time per phase of run_step in
+        recorder: recorder.TrajectoryRecorder to stream the state after every step to
+        parameters: dict of behavioral constants to change, see parameters.DEFAULT_PARAMETERS
+        replica_seed: seed of the replica paths of the 'fish' engine, shoals with the same
+        replica_seed have the same replicas (common random numbers), if not given
+        paths are drawn from the simulation random stream (ValueError with other engines)
+        """
+        check_replica_seed(engine, replica_seed)
+
+        if effective_engine(engine) != engine:
+            logger.warning('numba is not installed, using the fish engine instead of jit')
+            engine = 'fish'
 
         self.free_run = free_run
+        self.engine = engine
+
+        # all the random draws of the simulation come from this generator
+        self.rng = rng if rng is not None else np.random.default_rng(seed)
+        self.sampler = TruncatedNormalSampler(self.rng)
+
+        self.profiler = None
+        if profiler is not None:
+            self.set_profiler(profiler)
 
         if not free_run:
             self.width = 1500
@@ -55,12 +113,49 @@ class Simulation:
             # if will just never get there
             self.shaded_area_x = - 100
 
-        self.shoal = [Fish(self.get_starting_x(),
-                           self.get_starting_y(),
-                           self.width, self.height, self.shaded_area_x,
-                           decision_x=self.decision_x,
-                           follow_refugia_force=follow_refugia_force)
-                      for _ in range(fishes)]
+        # walls and obstacle geometry, shared by all the fishes
+        self.arena = Arena(self.width, self.height, resolution=10)
+
+        self.parameters = get_parameters(parameters)
+
+        # fishes react to neighbors closer than interaction_distance (100)
+        self.neighbor_grid = NeighborGrid(cell_size=max(100, self.parameters['interaction_distance']))
+
+        # fishes that are not in the shaded area yet are never further left than this,
+        # so agents left of freeze_x can't be their neighbors anymore
+        self.active_min_x = self.shaded_area_x - self.parameters['max_speed']
+        self.freeze_x = self.active_min_x - self.neighbor_grid.cell_size
+        # fishes in the shaded area (at x = 10) are too far from everyone, to be neighbors
+        self.drop_arrived = self.active_min_x - 10 > self.neighbor_grid.cell_size
+
+        if engine == 'fish':
+            self.shoal = [Fish(self.get_starting_x(),
+                               self.get_starting_y(),
+                               self.width, self.height, self.shaded_area_x,
+                               decision_x=self.decision_x,
+                               follow_refugia_force=follow_refugia_force,
+                               arena=self.arena, rng=self.rng, sampler=self.sampler,
+                               parameters=self.parameters)
+                          for _ in range(fishes)]
+
+            # agents that are still updated, agents that can still be neighbors
+            # and fishes that have not decided yet
+            self.active = list(self.shoal)
+            self.neighbors = list(self.shoal)
+            self.undecided = list(self.shoal)
+            self.top = self.bottom = 0
+
+            # replicas only follow their paths, drawn in add_replica:
+            # [replica, (T, 2) positions, (T, 2) velocities] of the replicas still moving
+            self.replica_paths = []
+            self.replica_sampler = TruncatedNormalSampler(replica_seed) \
+                if replica_seed is not None else self.sampler
+            self.steps = 0
+        elif engine in ('vectorized', 'jit'):
+            starting_positions = [(self.get_starting_x(), self.get_starting_y())
+                                  for _ in range(fishes)]
+        else:
+            raise ValueError(f'Unknown engine: {engine}')
 
         self.replica_y_start = self.box_top + self.box_width / 2
         self.replica_x_start = self.width - self.box_padding_left - self.box_width / 2
@@ -73,6 +168,28 @@ class Simulation:
         for i in range(replicas_bottom):
             self.add_replica(i, 'bottom')
 
+        if engine in ('vectorized', 'jit'):
+            shoal_class = VectorizedShoal
+            if engine == 'jit':
+                import kernels
+                shoal_class = kernels.JitShoal
+            self.shoal = shoal_class(starting_positions, self.width, self.height,
+                                     self.shaded_area_x, self.decision_x,
+                                     replicas_coordinates=self.replicas_coordinates,
+                                     follow_refugia_force=follow_refugia_force,
+                                     rng=self.rng, sampler=self.sampler,
+                                     parameters=self.parameters)
+
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.start(self)
+
+    def set_profiler(self, profiler):
+        """Profile run_step with profiler (profiling.Profiler), None to stop"""
+        if profiler is not None:
+            profiler.sampler = self.sampler
+        self.profiler = profiler
+
     def add_replica(self, replica_id, position):
         x = self.get_replica_x(replica_id)
         y = self.get_replica_y(x, position)
@@ -80,9 +197,45 @@ class Simulation:
         final_y = self.get_replica_y(0, position)
         self.replicas_coordinates.append((x, y, final_y))
 
+        # vectorized shoal creates replicas from coordinates
+        if self.engine != 'fish':
+            return
+
         replica = Fish(x, y, self.width, self.height, self.shaded_area_x,
-                       replica=True, replica_final_y=final_y)
+                       replica=True, replica_final_y=final_y, arena=self.arena,
+                       rng=self.rng, sampler=self.sampler, parameters=self.parameters)
         self.shoal.append(replica)
+        self.neighbors.append(replica)
+
+        # the whole path until the replica can't be a neighbor anymore
+        positions, velocities = replica_path(self.replica_sampler, x, y, replica.velocity.x,
+                                             replica.velocity.y, self.freeze_x)
+        self.replica_paths.append([replica, positions, velocities])
+
+    def move_replicas(self):
+        """Put replicas to the positions of their paths after the current step"""
+        for replica, positions, velocities in self.replica_paths:
+            i = min(self.steps, len(positions) - 1)
+            replica.position = Vector(*positions[i])
+            replica.velocity = Vector(*velocities[i])
+
+        self.steps += 1
+
+    def compact(self):
+        """
+        Stop updating fishes in the shaded area and replicas left of freeze_x,
+        nothing they do can change other fishes anymore
+        """
+        finished = {agent for agent in self.active if agent.reached_shaded_area}
+        finished |= {replica for replica, _, _ in self.replica_paths
+                     if replica.position.x < self.freeze_x}
+        if not finished:
+            return
+
+        self.active = [agent for agent in self.active if agent not in finished]
+        self.replica_paths = [path for path in self.replica_paths if path[0] not in finished]
+        self.neighbors = [agent for agent in self.neighbors if agent not in finished
+                          or agent.reached_shaded_area and not self.drop_arrived]
 
     def get_replica_x(self, replica_id):
         # inside
@@ -100,13 +253,44 @@ class Simulation:
                 / x_initial + self.replica_final_y_bottom
 
     def get_starting_x(self, position=None):
-        return self.box_left + np.random.random() * self.box_width
+        return self.box_left + self.rng.random() * self.box_width
 
     def get_starting_y(self, position=None):
         # random position
-        return self.box_top + np.random.random() * self.box_width
+        return self.box_top + self.rng.random() * self.box_width
+
+    def get_positions(self):
+        """(N, 2) array with positions of all the fishes and replicas"""
+        if self.engine != 'fish':
+            return self.shoal.position[0, self.shoal.present[0]].copy()
+
+        return np.array([(fish.position.x, fish.position.y) for fish in self.shoal])
+
+    def get_velocities(self):
+        """(N, 2) array with velocities of all the fishes and replicas"""
+        if self.engine != 'fish':
+            return self.shoal.velocity[0, self.shoal.present[0]].copy()
+
+        return np.array([(fish.velocity.x, fish.velocity.y) for fish in self.shoal])
+
+    def get_decisions(self):
+        """(N,) array with decision codes (shoal.UNDECIDED, TOP or BOTTOM) of all the agents"""
+        if self.engine != 'fish':
+            return self.shoal.decision[0, self.shoal.present[0]].copy()
+
+        return np.array([DECISION_CODES[fish.decision] for fish in self.shoal], dtype=np.int8)
+
+    def get_replicas(self):
+        """(N,) mask of replicas among all the agents"""
+        if self.engine != 'fish':
+            return self.shoal.replica[0, self.shoal.present[0]].copy()
+
+        return np.array([fish.replica for fish in self.shoal], dtype=bool)
 
     def draw_objects(self):
+        # p5 needs glfw, so it's only imported for drawing
+        from p5 import background, fill, quad, triangle, rect, line
+
         # global simulation
 
         # triangle((0, 0), (0, 200), (350, 100))
@@ -146,67 +330,486 @@ class Simulation:
         if visualize:
             self.draw_objects()
 
-        for fish in self.shoal:
-            fish.update(self.shoal)
+        # profile only the sampled steps
+        profiler = self.profiler if self.profiler is not None and self.profiler.step() else None
+
+        if self.engine != 'fish':
+            self.shoal.update(profiler=profiler)
+            if visualize:
+                self.shoal.show()
+
+            decisions = self.shoal.count_decisions()
+            if profiler:
+                profiler.lap('decision bookkeeping')
+
+            if self.recorder is not None:
+                self.recorder.record(self)
+
+            return decisions
+
+        self.neighbor_grid.rebuild(self.neighbors)
+
+        if profiler:
+            profiler.lap('neighbor search')
+
+        for fish in self.active:
+            fish.update(self.neighbors, grid=self.neighbor_grid, profiler=profiler)
+            # keep the grid in sync with the new position
+            self.neighbor_grid.update(fish)
+            if profiler:
+                profiler.lap('neighbor search')
             # to test with one fish
             # fish.update_one(fishes)
-            if visualize:
+
+        # replicas move after the fishes, like when they were updated last
+        self.move_replicas()
+        if profiler:
+            profiler.lap('replicas')
+
+        if visualize:
+            for fish in self.shoal:
                 fish.show()
 
-        fishes_not_replica = list(filter(lambda f: not f.replica, self.shoal))
-        top = len(list(filter(lambda f: f.decision == 'top', fishes_not_replica)))
-        bottom = len(list(filter(lambda f: f.decision == 'bottom', fishes_not_replica)))
+        # count only the fishes that decided in this step
+        for fish in self.undecided:
+            if fish.decision == 'top':
+                self.top += 1
+            elif fish.decision == 'bottom':
+                self.bottom += 1
+        self.undecided = [fish for fish in self.undecided if not fish.decision]
+
+        self.compact()
 
-        total = top + bottom
-        all_dicided = total == len(fishes_not_replica)
+        all_dicided = not self.undecided
+        top, bottom = self.top, self.bottom
+
+        if profiler:
+            profiler.lap('decision bookkeeping')
+
+        if self.recorder is not None:
+            self.recorder.record(self)
 
         return all_dicided, top, bottom
 
 
 def setup():
+    from p5 import size
+
     # global simulation
     # this happens just once
     size(simulation.width, simulation.height)  # instead of create_canvas
 
 
 def draw():
-    simulation.run_step()
+    if replay is not None:
+        replay.run_step()
+    else:
+        simulation.run_step()
+
+
+def spawn_seeds(seed, n):
+    """Spawn n independent np.random.SeedSequence from seed (int, SeedSequence or None)"""
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    return seed.spawn(n)
+
+
+def shoal_seeds(seed, shoals):
+    """
+    Independent integer seeds, one per shoal, derived from one root seed,
+    63 bit, so streams of the many shoals of sweeps and calibrations don't collide,
+    and seeds still fit a signed 64 bit integer (e.g. the result cache)
+    """
+    return [int(s.generate_state(1, np.uint64)[0] >> np.uint64(1)) for s in spawn_seeds(seed, shoals)]
+
+
+def headless_simulation(fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2,
+                        engine='fish', seed=None, trajectory=None, profiler=None, cache=None,
+                        recorder=None, parameters=None, replica_seed=None):
+    """
+    seed: seed of the shoal random stream, e.g. one of shoal_seeds to re-run a shoal of a sweep
+    trajectory: list to append positions of all the agents after every step to
+    profiler: profiling.Profiler to collect time per phase in, can be shared by many shoals
+    cache: cache.ResultCache to take the result from or store it in (shoals with integer seed only)
+    recorder: recorder.TrajectoryRecorder to stream positions, velocities and decisions
+    of every step to, closed when the shoal is finished
+    parameters: dict of behavioral constants to change, see parameters.DEFAULT_PARAMETERS
+    replica_seed: seed of the replica paths (Fish engine only), the same for shoals that should
+    share their replicas
+    """
+    # before the cache, that would return shoals of other engines for any replica_seed
+    check_replica_seed(engine, replica_seed)
+    engine = effective_engine(engine)
+    configuration = dict(fishes=fishes, replicas_top=replicas_top, replicas_bottom=replicas_bottom,
+                         follow_refugia_force=follow_refugia_force, engine=engine,
+                         parameters=parameters, replica_seed=replica_seed)
+    # trajectory and profile need the shoal to be simulated
+    use_cache = cache is not None and trajectory is None and profiler is None and recorder is None
+    if use_cache:
+        result = cache.get(configuration, seed)
+        if result is not None:
+            return result
 
-
-def headless_simulation(fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2):
     start = time.time()
     simulation = Simulation(fishes=fishes, replicas_top=replicas_top,
-                            replicas_bottom=replicas_bottom, follow_refugia_force=follow_refugia_force)
+                            replicas_bottom=replicas_bottom, follow_refugia_force=follow_refugia_force,
+                            engine=engine, seed=seed, profiler=profiler, recorder=recorder,
+                            parameters=parameters, replica_seed=replica_seed)
 
     all_dicided = False
     step = 0
 
     while not all_dicided:
         step += 1
-        print(f'step: {step}', end='\r')
         all_dicided, top, bottom = simulation.run_step(False)
 
-    print(f'Decided top: {top}, decided bottom: {bottom}, steps: {step}')
+        if trajectory is not None:
+            trajectory.append(simulation.get_positions())
+
+    if recorder is not None:
+        recorder.close()
+
     end = time.time()
 
-    print(f'total time: {end - start:.2f}')
+    log_summary('shoal finished', fishes=fishes, replicas_top=replicas_top,
+                replicas_bottom=replicas_bottom, seed=seed, top=top, bottom=bottom, steps=step,
+                time=round(end - start, 3), steps_per_s=steps_per_second(step, end - start))
+
+    if use_cache:
+        cache.put(configuration, seed, (top, bottom))
+
     return top, bottom
 
 
-def headless_simulations(shoals=20, fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2):
-    top_preference_proportions = []
+def seeded_headless_simulation(configuration, seed):
+    """headless_simulation for a configuration dict, used by run_shoals workers"""
+    return headless_simulation(seed=seed, **configuration)
+
+
+def map_shoals(configurations, seeds, workers=None):
+    """
+    Yield (top, bottom) of headless_simulation for every configuration and seed in order,
+    simulated in a pool of %workers processes if workers is given
+    """
+    if not workers or workers == 1:
+        for configuration, seed in zip(configurations, seeds):
+            yield seeded_headless_simulation(configuration, seed)
+
+        return
+
+    chunksize = max(1, len(configurations) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(seeded_headless_simulation, configurations, seeds,
+                                chunksize=chunksize)
+
+
+def seeded_headless_simulations(configurations, seeds):
+    """seeded_headless_simulation for a chunk of shoals, sent to a worker at once"""
+    return [seeded_headless_simulation(configuration, seed)
+            for configuration, seed in zip(configurations, seeds)]
+
+
+def get_chunks(configurations, seeds, chunksize):
+    """(indexes, configurations, seeds) of every chunk of %chunksize shoals"""
+    for start in range(0, len(configurations), chunksize):
+        stop = min(start + chunksize, len(configurations))
+        yield range(start, stop), configurations[start:stop], seeds[start:stop]
+
+
+def iter_shoals(configurations, seeds, workers=None, chunksize=1):
+    """
+    Yield (index, (top, bottom)) of headless_simulation for every configuration and seed
+    as soon as the shoal is finished, simulated in a pool of %workers processes if workers
+    is given (in order otherwise)
+    chunksize: shoals sent to a worker at once, more for short shoals (e.g. engine='jit')
+
+    Closing the generator (e.g. break out of the loop) cancels the shoals,
+    that haven't started yet
+    """
+    configurations, seeds = list(configurations), list(seeds)
+
+    if not workers or workers == 1:
+        for i, (configuration, seed) in enumerate(zip(configurations, seeds)):
+            yield i, seeded_headless_simulation(configuration, seed)
+
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(seeded_headless_simulations, chunk_configurations, chunk_seeds):
+                   indexes
+                   for indexes, chunk_configurations, chunk_seeds
+                   in get_chunks(configurations, seeds, chunksize)}
+        try:
+            for future in as_completed(futures):
+                yield from zip(futures[future], future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+async def async_shoals(configurations, seeds, executor=None, workers=None, chunksize=1):
+    """
+    Async version of iter_shoals, the shoals are simulated in executor (a pool of %workers
+    processes is started if not given), so the event loop keeps running meanwhile.
+    Shoals that haven't started yet are cancelled if the iteration is stopped
+    """
+    loop = asyncio.get_running_loop()
+    configurations, seeds = list(configurations), list(seeds)
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=workers)
+
+    futures = {loop.run_in_executor(executor, seeded_headless_simulations, chunk_configurations,
+                                    chunk_seeds): indexes
+               for indexes, chunk_configurations, chunk_seeds
+               in get_chunks(configurations, seeds, chunksize)}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                for i, result in zip(futures[future], future.result()):
+                    yield i, result
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+def iter_simulations(shoals=20, fishes=2, replicas_top=0, replicas_bottom=0,
+                     follow_refugia_force=0.2, engine='fish', workers=None, seed=None, chunksize=1):
+    """
+    Yield (shoal index, top preference proportion) of the shoals of headless_simulations
+    as soon as each of them is finished, e.g. to update a histogram while they run
+    (shoals are the same as of headless_simulations with the same seed)
+    """
+    configuration = dict(fishes=fishes, replicas_top=replicas_top, replicas_bottom=replicas_bottom,
+                         follow_refugia_force=follow_refugia_force, engine=engine)
+    for i, (top, bottom) in iter_shoals([configuration] * shoals, shoal_seeds(seed, shoals),
+                                        workers=workers, chunksize=chunksize):
+        yield i, top / fishes
+
+
+async def async_simulations(shoals=20, fishes=2, replicas_top=0, replicas_bottom=0,
+                            follow_refugia_force=0.2, engine='fish', executor=None, workers=None,
+                            seed=None, chunksize=1):
+    """Async version of iter_simulations, see async_shoals"""
+    configuration = dict(fishes=fishes, replicas_top=replicas_top, replicas_bottom=replicas_bottom,
+                         follow_refugia_force=follow_refugia_force, engine=engine)
+    async for i, (top, bottom) in async_shoals([configuration] * shoals, shoal_seeds(seed, shoals),
+                                               executor=executor, workers=workers,
+                                               chunksize=chunksize):
+        yield i, top / fishes
+
+
+def run_shoals(configurations, seeds, workers=None, cache=None, checkpoint=None):
+    """
+    Run headless_simulation for every configuration (dict of it's arguments)
+    with it's own seed, in a pool of %workers processes if workers is given.
+    cache: cache.ResultCache, shoals found in it are not simulated again
+    checkpoint: started checkpoint.Checkpoint, every finished shoal is saved to it
+    and shoals saved before are not simulated again
+    Returns (top, bottom) in the order of configurations
+    """
+    results = [None] * len(configurations)
+
+    if checkpoint is not None:
+        for i, result in checkpoint.load(seeds).items():
+            results[i] = result
+        logger.info('%s of %s shoals in checkpoint', sum(r is not None for r in results),
+                    len(results))
+
+    if cache is not None:
+        missing = [i for i, result in enumerate(results) if result is None]
+        cached = cache.get_many([configurations[i] for i in missing], [seeds[i] for i in missing])
+        logger.info('%s of %s shoals cached', sum(r is not None for r in cached), len(missing))
+
+        for i, result in zip(missing, cached):
+            if result is not None:
+                results[i] = result
+                if checkpoint is not None:
+                    checkpoint.add(i, seeds[i], result)
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    progress = Progress(total=len(missing))
+
+    computed = map_shoals([configurations[i] for i in missing], [seeds[i] for i in missing],
+                          workers=workers)
+    for i, result in zip(missing, computed):
+        results[i] = result
+        if checkpoint is not None:
+            checkpoint.add(i, seeds[i], result)
+        progress.update()
+
+    if cache is not None and missing:
+        cache.put_many([configurations[i] for i in missing], [seeds[i] for i in missing],
+                       [results[i] for i in missing])
+
+    return results
+
+
+def ensemble_simulations(configurations, follow_refugia_force=0.2, seed=None):
+    """
+    Simulate many shoals together as one shoal.ShoalEnsemble.
+    configurations: list of (fishes, replicas_top, replicas_bottom), one per shoal
+
+    Yields (shoal index, top, bottom) for every shoal as soon as all it's fishes decided
+    """
+    start = time.time()
+    # a stream per shoal for the initial positions and one for the ensemble steps
+    seeds = spawn_seeds(seed, len(configurations) + 1)
+
+    simulations = [Simulation(fishes=fishes, replicas_top=replicas_top,
+                              replicas_bottom=replicas_bottom,
+                              follow_refugia_force=follow_refugia_force, engine='vectorized',
+                              seed=shoal_seed)
+                   for (fishes, replicas_top, replicas_bottom), shoal_seed in zip(configurations, seeds)]
+    ensemble = ShoalEnsemble.stack([simulation.shoal for simulation in simulations], rng=seeds[-1])
+
+    progress = Progress(total=len(configurations))
+    step = 0
+    while not ensemble.finished.all():
+        step += 1
+        ensemble.update()
+        progress.update(0, steps=1)
 
-    for i in range(shoals):
-        print(f'\n\nShoal {i + 1} of {shoals}')
-        top, bottom = headless_simulation(fishes=fishes, replicas_top=replicas_top,
-                                          replicas_bottom=replicas_bottom,
-                                          follow_refugia_force=follow_refugia_force)
+        for shoal, top, bottom in zip(*ensemble.finish_decided()):
+            log_summary('shoal finished', shoal=int(shoal), top=int(top), bottom=int(bottom),
+                        steps=step)
+            progress.update()
+            yield int(shoal), int(top), int(bottom)
+
+    end = time.time()
+    log_summary('ensemble finished', shoals=len(configurations), steps=step,
+                time=round(end - start, 3), steps_per_s=steps_per_second(step, end - start))
+
+
+def check_ensemble(engine='fish', workers=None, cache=None):
+    """
+    Raise ValueError for arguments an ensemble can't use: it always runs the vectorized
+    engine in one process, and shoals share one random stream, so they can't be cached
+    """
+    unsupported = []
+    if engine not in ('fish', 'vectorized'):
+        unsupported.append(f'engine={engine!r}')
+    if workers is not None:
+        unsupported.append('workers')
+    if cache is not None:
+        unsupported.append('cache')
+
+    if unsupported:
+        raise ValueError(f'ensemble does not support {", ".join(unsupported)}')
+
+
+def headless_simulations(shoals=20, fishes=2, replicas_top=0, replicas_bottom=0, follow_refugia_force=0.2,
+                         engine='fish', ensemble=False, workers=None, seed=None, cache=None,
+                         ci_width=None, stable_verdict=None, max_shoals=None, batch=10):
+    """
+    ensemble: simulate all the shoals together with ensemble_simulations
+    (always uses the vectorized engine, engine, workers and cache are not supported)
+    workers: number of processes to spread shoals across
+    seed: root seed, every shoal gets it's own seed spawned from it,
+    so results don't depend on the number of workers
+    cache: cache.ResultCache to reuse shoals simulated before with the same root seed
+
+    ci_width, stable_verdict, max_shoals, batch: keep adding shoals after the first %shoals,
+    see sequential_simulations
+    """
+    if ci_width is not None or stable_verdict is not None:
+        if ensemble:
+            raise ValueError('ensemble does not support sequential stopping')
+
+        configuration = dict(fishes=fishes, replicas_top=replicas_top,
+                             replicas_bottom=replicas_bottom,
+                             follow_refugia_force=follow_refugia_force, engine=engine)
+        return sequential_simulations(configuration, min_shoals=shoals, ci_width=ci_width,
+                                      stable_verdict=stable_verdict, max_shoals=max_shoals,
+                                      batch=batch, workers=workers, seed=seed, cache=cache)
+
+    if ensemble:
+        check_ensemble(engine, workers, cache)
+        top_preference_proportions = [None] * shoals
+        configurations = [(fishes, replicas_top, replicas_bottom)] * shoals
+
+        for i, top, bottom in ensemble_simulations(configurations, follow_refugia_force, seed=seed):
+            top_preference_proportions[i] = top / fishes
+
+        logger.info('Proportions: %s', top_preference_proportions)
+        return top_preference_proportions
+
+    # shoal seeds spawned from fresh entropy would never be asked for again
+    if seed is None:
+        cache = None
+
+    configuration = dict(fishes=fishes, replicas_top=replicas_top, replicas_bottom=replicas_bottom,
+                         follow_refugia_force=follow_refugia_force, engine=engine)
+    results = run_shoals([configuration] * shoals, shoal_seeds(seed, shoals), workers=workers,
+                         cache=cache)
+
+    top_preference_proportions = []
+    for top, bottom in results:
         top_preference_proportion = top / fishes
         top_preference_proportions.append(top_preference_proportion)
 
-    print(f'Proportions: {top_preference_proportions}')
+    logger.info('Proportions: %s', top_preference_proportions)
     return top_preference_proportions
 
+
+def sequential_simulations(configuration, min_shoals=20, ci_width=None, stable_verdict=None,
+                           max_shoals=None, batch=10, confidence=0.95, workers=None, seed=None,
+                           cache=None):
+    """
+    Simulate shoals of configuration (dict of headless_simulation arguments) in batches,
+    until the mean top preference proportion is known well enough:
+    ci_width: stop when the confidence interval of the mean is not wider than ci_width
+    stable_verdict: stop when hypothesis_testing.distribution_significance gave the same
+    verdict after %stable_verdict batches in a row
+    max_shoals: never simulate more shoals than this (10 * min_shoals by default)
+
+    Shoals get the same seeds, as in headless_simulations(seed=seed),
+    so the first n proportions match a run with n shoals
+    """
+    # scipy is only needed here, not by the shoals
+    from hypothesis_testing import mean_confidence_interval, distribution_significance
+
+    max_shoals = max_shoals if max_shoals is not None else 10 * min_shoals
+    fishes = configuration['fishes']
+
+    seeds = shoal_seeds(seed, max_shoals)
+    if seed is None:
+        cache = None
+
+    proportions = []
+    verdicts = []
+    n = min(min_shoals, max_shoals)
+
+    while True:
+        results = run_shoals([configuration] * (n - len(proportions)), seeds[len(proportions):n],
+                             workers=workers, cache=cache)
+        proportions += [top / fishes for top, bottom in results]
+
+        low, high = mean_confidence_interval(proportions, confidence)
+        done = ci_width is not None and high - low <= ci_width
+
+        if stable_verdict is not None:
+            verdicts.append(distribution_significance(proportions, fishes))
+            done |= len(verdicts) >= stable_verdict and len(set(verdicts[-stable_verdict:])) == 1
+
+        log_summary('sequential batch', shoals=len(proportions), mean=round(np.mean(proportions), 3),
+                    ci=(round(low, 3), round(high, 3)),
+                    verdict=verdicts[-1] if verdicts else None)
+
+        if done or len(proportions) >= max_shoals:
+            break
+
+        n = min(n + batch, max_shoals)
+
+    logger.info('Proportions: %s', proportions)
+    return proportions
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--fishes", dest="fishes",
@@ -224,15 +827,33 @@ if __name__ == '__main__':
                         nargs='?', const=False, type=bool, default=False,
                         help="define if run in free mode (default=False)")
 
+    parser.add_argument("-e", "--engine", dest="engine",
+                        nargs='?', const='fish', type=str, default='fish',
+                        choices=['fish', 'vectorized', 'jit'],
+                        help="define how the shoal is updated (default = fish)")
+
+    parser.add_argument("--replay", dest="replay", default=None,
+                        help="directory with steps saved by recorder.TrajectoryRecorder to show "
+                             "instead of simulating")
+
     args = parser.parse_args()
     print(args)
     print(args.fishes)
 
-    simulation = Simulation(fishes=args.fishes,
-                            replicas_top=args.replicas_top,
-                            replicas_bottom=args.replicas_bottom,
-                            free_run=args.free_run)
-
+    replay = None
+    if args.replay:
+        reader = TrajectoryReader(args.replay)
+        # simulation without replicas only draws the arena
+        simulation = Simulation(fishes=0, free_run=reader.meta['free_run'])
+        replay = Replay(reader, simulation)
+    else:
+        simulation = Simulation(fishes=args.fishes,
+                                replicas_top=args.replicas_top,
+                                replicas_bottom=args.replicas_bottom,
+                                free_run=args.free_run,
+                                engine=args.engine)
+
+    from p5 import run
     run()
     # run(frame_rate=25)
     # run(frame_rate=1000)
@@ -0,0 +1,60 @@
+from math import floor
+
+
+class NeighborGrid:
+    """
+    Uniform grid of square cells with fishes in them,
+    used to find fishes close to a position without scanning the whole shoal
+
+    Fishes interact only within cell_size, so all the neighbors that matter
+    are in the 3x3 cells around the fish. The grid is rebuilt once per step
+    and every fish is moved to it's new cell right after it's update,
+    so it always matches current positions.
+    """
+
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        # cell -> fishes in it (dict keeps insertion order, like the shoal list)
+        self.cells = {}
+        self.fish_cells = {}
+
+    def get_cell(self, position):
+        return floor(position.x / self.cell_size), floor(position.y / self.cell_size)
+
+    def rebuild(self, fishes):
+        self.cells = {}
+        self.fish_cells = {}
+
+        for fish in fishes:
+            self.add(fish)
+
+    def add(self, fish):
+        cell = self.get_cell(fish.position)
+        self.cells.setdefault(cell, {})[fish] = None
+        self.fish_cells[fish] = cell
+
+    def update(self, fish):
+        """Move fish to the cell of it's current position"""
+        cell = self.get_cell(fish.position)
+        old_cell = self.fish_cells.get(fish)
+
+        if cell == old_cell:
+            return
+
+        if old_cell is not None:
+            del self.cells[old_cell][fish]
+        self.cells.setdefault(cell, {})[fish] = None
+        self.fish_cells[fish] = cell
+
+    def get_candidates(self, position):
+        """Fishes in the 3x3 cells around position, a superset of fishes within cell_size"""
+        x, y = self.get_cell(position)
+
+        candidates = []
+        for i in (x - 1, x, x + 1):
+            for j in (y - 1, y, y + 1):
+                cell = self.cells.get((i, j))
+                if cell:
+                    candidates.extend(cell)
+
+        return candidates
@@ -0,0 +1,219 @@
+"""
+Sweeps over the model parameters and the experimental setups
+
+A sweep is described by a spec (a dict or a JSON file):
+
+    {"grid": {"follow_refugia_force": [0.1, 0.2, 0.3], "max_speed": [15, 17]},
+     "shoals": 30, "seed": 1}
+
+    {"latin_hypercube": {"max_speed": [12, 20], "interaction_distance": [80, 120]},
+     "samples": 20, "shoals": 30, "seed": 1, "setups": [[1, 1], [0, 3]], "group_sizes": [4]}
+
+    {"points": [{"max_speed": 15}, {"max_speed": 16, "repulsion_distance": 5}], "shoals": 30}
+
+Every combination of parameters (a point) is run for all the setups and group
+sizes, the shoals of all the points share the seeds of run_set(seed=seed)
+(seed is 0 if not given), so points are compared on the same random numbers. Every finished shoal is
+appended as a row to the output CSV, shoals already in it are not simulated again.
+
+    python3 sweep.py spec.json --output sweep.csv --workers 8
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+
+import numpy as np
+
+from experimental_setups import SETUPS
+from experiments import set_seeds
+from logs import logger, configure_logging, Progress
+from parameters import DEFAULT_PARAMETERS, get_parameters
+from simulation import map_shoals, effective_engine
+
+# parameters a sweep can change
+SWEEP_PARAMETERS = ['follow_refugia_force'] + list(DEFAULT_PARAMETERS)
+DEFAULT_VALUES = dict(DEFAULT_PARAMETERS, follow_refugia_force=0.2)
+
+COLUMNS = ['point'] + SWEEP_PARAMETERS + ['replicas_bottom', 'replicas_top', 'fishes', 'shoal',
+                                          'seed', 'engine', 'top', 'bottom', 'proportion']
+# columns that identify a shoal
+KEY_COLUMNS = SWEEP_PARAMETERS + ['replicas_bottom', 'replicas_top', 'fishes', 'seed', 'engine']
+
+
+def validate(names):
+    unknown = set(names) - set(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f'Unknown sweep parameters: {", ".join(sorted(unknown))}')
+
+
+def grid(values):
+    """Every combination of values: {name: [value, ...]} -> [{name: value}, ...]"""
+    validate(values)
+    names = list(values)
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*(values[name] for name in names))]
+
+
+def latin_hypercube(ranges, samples, seed=None, decimals=6):
+    """
+    %samples points from {name: (low, high)}, every range is split into %samples
+    equal strata and every stratum is used by exactly one point
+    """
+    validate(ranges)
+    rng = np.random.default_rng(seed)
+
+    points = [{} for _ in range(samples)]
+    for name, (low, high) in ranges.items():
+        strata = rng.permutation(samples)
+        values = low + (strata + rng.random(samples)) / samples * (high - low)
+        for point, value in zip(points, values):
+            point[name] = round(float(value), decimals)
+
+    return points
+
+
+def get_points(spec):
+    """Points of the spec with all the sweep parameters, duplicates removed"""
+    if 'grid' in spec:
+        points = grid(spec['grid'])
+    elif 'latin_hypercube' in spec:
+        points = latin_hypercube(spec['latin_hypercube'], spec['samples'], spec.get('seed', 0))
+    elif 'points' in spec:
+        points = spec['points']
+        for point in points:
+            validate(point)
+    else:
+        raise ValueError('Sweep spec needs grid, latin_hypercube or points')
+
+    unique = {}
+    for point in points:
+        point = dict(DEFAULT_VALUES, **point)
+        unique.setdefault(tuple(point[name] for name in SWEEP_PARAMETERS), point)
+
+    return list(unique.values())
+
+
+def get_jobs(spec):
+    """Rows of the result table without results, one per shoal"""
+    setups = [tuple(setup) for setup in spec.get('setups', SETUPS)]
+    group_sizes = spec.get('group_sizes', [2, 4, 8])
+    shoals = spec.get('shoals', 30)
+    # record the engine, that simulates the shoals
+    engine = effective_engine(spec.get('engine', 'fish'))
+
+    # seeds as in run_set, the same for all the points
+    seeds = set_seeds(spec.get('seed', 0), shoals, setups, group_sizes)
+
+    jobs = []
+    for i, point in enumerate(get_points(spec)):
+        for replicas_bottom, replicas_top in setups:
+            for fishes in group_sizes:
+                for shoal, seed in enumerate(seeds[(replicas_bottom, replicas_top, fishes)]):
+                    jobs.append(dict(point, point=i, replicas_bottom=replicas_bottom,
+                                     replicas_top=replicas_top, fishes=fishes, shoal=shoal,
+                                     seed=seed, engine=engine))
+
+    return jobs
+
+
+def get_key(row):
+    return tuple(str(row[column]) for column in KEY_COLUMNS)
+
+
+def get_configuration(job):
+    """headless_simulation arguments of a job"""
+    return dict(fishes=job['fishes'], replicas_top=job['replicas_top'],
+                replicas_bottom=job['replicas_bottom'],
+                follow_refugia_force=job['follow_refugia_force'], engine=job['engine'],
+                parameters=get_parameters({name: job[name] for name in DEFAULT_PARAMETERS}))
+
+
+def parse_value(value):
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+
+    return value
+
+
+def read_table(path):
+    """Rows of the table in path, with numbers parsed"""
+    if not os.path.exists(path):
+        return []
+
+    with open(path, newline='') as f:
+        return [{column: parse_value(value) for column, value in row.items()}
+                for row in csv.DictReader(f)]
+
+
+def run_sweep(spec, output='sweep.csv', workers=None, cache=None):
+    """
+    Simulate all the shoals of spec, that are not in the output table yet,
+    and append them to it. Returns the rows of the whole sweep
+    cache: cache.ResultCache to take shoals simulated by other runs from
+    """
+    jobs = get_jobs(spec)
+    done = {get_key(row): row for row in read_table(output)}
+    missing = [job for job in jobs if get_key(job) not in done]
+    logger.info('%s points, %s shoals, %s already simulated', len(get_points(spec)), len(jobs),
+                len(jobs) - len(missing))
+
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0
+    with open(output, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if new_file:
+            writer.writeheader()
+
+        def write(job, result):
+            top, bottom = result
+            row = dict(job, top=top, bottom=bottom, proportion=top / job['fishes'])
+            writer.writerow(row)
+            f.flush()
+            done[get_key(job)] = row
+
+        configurations = [get_configuration(job) for job in missing]
+        seeds = [job['seed'] for job in missing]
+
+        if cache is not None:
+            cached = cache.get_many(configurations, seeds)
+            for job, result in zip(missing, cached):
+                if result is not None:
+                    write(job, result)
+
+            left = [i for i, result in enumerate(cached) if result is None]
+            missing = [missing[i] for i in left]
+            configurations = [configurations[i] for i in left]
+            seeds = [seeds[i] for i in left]
+
+        progress = Progress(total=len(missing))
+        results = []
+        for job, result in zip(missing, map_shoals(configurations, seeds, workers=workers)):
+            write(job, result)
+            results.append(result)
+            progress.update()
+
+        if cache is not None:
+            cache.put_many(configurations, seeds, results)
+
+    # point numbers of the current spec
+    return [dict(done[get_key(job)], point=job['point'], shoal=job['shoal']) for job in jobs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("spec", help="JSON file with the sweep spec")
+    parser.add_argument("-o", "--output", dest="output", default='sweep.csv',
+                        help="CSV table to append the shoals to (default = sweep.csv)")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=None,
+                        help="number of processes to simulate shoals in")
+    args = parser.parse_args()
+
+    configure_logging()
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    run_sweep(spec, output=args.output, workers=args.workers)
@@ -1,9 +1,181 @@
-from scipy.stats import truncnorm
+from math import erf, sqrt
 
-def random_trunc(mean=0, sd=1, low=0, upp=20):
-    x = get_truncated_normal(mean=mean, sd=sd, low=low, upp=upp)
-    return x.rvs()
+import numpy as np
+
+
+class TruncatedNormalSampler:
+    """
+    Draws truncated normal samples in bulk and hands them out one by one
+
+    Samples are drawn from the standard truncated normal with bounds
+    a = (low - mean) / sd and b = (upp - mean) / sd and then scaled back,
+    so every parameter set with the same standardized bounds shares one
+    buffer of pre-drawn samples (e.g. the turning angle, that is always
+    mean +- 0.4 with sd 0.1). Bounds that are seen only once are sampled
+    by rejection from a buffer of standard normal samples.
+    """
+
+    # how many times rejection is tried before falling back to truncnorm
+    max_rejections = 32
+    # buffers of bounds accepting less normal samples than this are filled by truncnorm
+    min_acceptance = 0.01
+    # limits for the number of buffers and remembered bounds
+    max_buffers = 256
+    max_seen = 4096
+
+    def __init__(self, seed=None, buffer_size=1024):
+        """seed: anything np.random.default_rng takes, including a Generator to share"""
+        self.buffer_size = buffer_size
+        # number of samples handed out, e.g. for profiling.Profiler
+        self.draws = 0
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.rng = np.random.default_rng(seed)
+        # standardized bounds -> [samples, index of the next sample]
+        self.buffers = {}
+        self.seen = {}
+        self.normal = [np.empty(0), 0]
+
+    def get_bounds(self, mean, sd, low, upp):
+        # round, so the same bounds computed from different means
+        # end up in the same buffer
+        return np.round((low - mean) / sd, 9), np.round((upp - mean) / sd, 9)
+
+    def get_buffer(self, a, b):
+        key = (float(a), float(b))
+        buffer = self.buffers.get(key)
+
+        if buffer is None:
+            hits = self.seen.get(key, 0) + 1
+            if hits < 2:
+                if len(self.seen) >= self.max_seen:
+                    self.seen.clear()
+                self.seen[key] = hits
+                return None
+
+            self.seen.pop(key, None)
+            if len(self.buffers) >= self.max_buffers:
+                # forget the oldest buffer
+                del self.buffers[next(iter(self.buffers))]
+            buffer = self.buffers[key] = [np.empty(0), 0]
+
+        return buffer
+
+    def take(self, buffer, n, fill):
+        """Take n samples from the buffer, drawing new ones with fill(size) if needed"""
+        samples, i = buffer
+        if i + n <= len(samples):
+            buffer[1] = i + n
+            return samples[i:i + n]
+
+        taken = [samples[i:]]
+        left = n - (len(samples) - i)
+        size = max(self.buffer_size, left)
+        samples = fill(size)
+        taken.append(samples[:left])
+        buffer[0], buffer[1] = samples, left
+
+        return np.concatenate(taken)
+
+    def take_truncated(self, a, b, n):
+        return self.take(self.buffers[(float(a), float(b))], n,
+                         lambda size: self.draw_truncated(a, b, size))
+
+    def draw_truncated(self, a, b, size):
+        """
+        Draw %size standard truncated normal samples for scalar bounds by rejection
+        from batches of normal samples, so scipy is only loaded for bounds far from the mean
+        """
+        acceptance = (erf(b / sqrt(2)) - erf(a / sqrt(2))) / 2
+        if acceptance < self.min_acceptance:
+            from scipy.stats import truncnorm
+            return truncnorm.rvs(a, b, size=size, random_state=self.rng)
+
+        taken = []
+        while size > 0:
+            candidates = self.rng.standard_normal(int(size / acceptance * 1.1) + 16)
+            accepted = candidates[(a <= candidates) & (candidates <= b)][:size]
+            taken.append(accepted)
+            size -= len(accepted)
+
+        return np.concatenate(taken)
+
+    def take_normal(self, n):
+        return self.take(self.normal, n, self.rng.standard_normal)
+
+    def draw_standard(self, a, b):
+        """Draw standard truncated normal samples for arrays of bounds by rejection"""
+        samples = np.empty(a.shape)
+        left = np.ones(a.shape, dtype=bool)
+
+        for _ in range(self.max_rejections):
+            n = left.sum()
+            if not n:
+                return samples
+
+            candidates = self.take_normal(n)
+            accepted = (a[left] <= candidates) & (candidates <= b[left])
+            indices = np.flatnonzero(left)[accepted]
+            samples.flat[indices] = candidates[accepted]
+            left.flat[indices] = False
+
+        # narrow bounds far from the mean
+        if left.any():
+            from scipy.stats import truncnorm
+            samples[left] = truncnorm.rvs(a[left], b[left], random_state=self.rng)
+
+        return samples
+
+    def draw(self, mean=0, sd=1, low=0, upp=20):
+        """Draw one sample"""
+        self.draws += 1
+        a, b = self.get_bounds(mean, sd, low, upp)
+
+        if self.get_buffer(a, b) is not None:
+            z = self.take_truncated(a, b, 1)[0]
+        else:
+            z = self.draw_standard(np.array([a]), np.array([b]))[0]
+
+        return min(max(mean + sd * z, low), upp)
+
+    def sample(self, mean=0, sd=1, low=0, upp=20, size=None):
+        """Draw samples for arrays of means and bounds at once"""
+        mean, low, upp = np.broadcast_arrays(*(np.asarray(p, dtype=float) for p in (mean, low, upp)))
+        if size is not None:
+            mean, low, upp = (np.broadcast_to(p, size) for p in (mean, low, upp))
+
+        if not mean.size:
+            return np.zeros(mean.shape)
+
+        self.draws += mean.size
+        a, b = self.get_bounds(mean, sd, low, upp)
+
+        # the same standardized bounds for all the samples
+        if np.all(a == a.flat[0]) and np.all(b == b.flat[0]) \
+                and self.get_buffer(a.flat[0], b.flat[0]) is not None:
+            z = self.take_truncated(a.flat[0], b.flat[0], mean.size).reshape(mean.shape)
+        else:
+            z = self.draw_standard(a, b)
+
+        return np.clip(mean + sd * z, low, upp)
+
+
+sampler = TruncatedNormalSampler()
+
+
+def seed(seed=None):
+    """Seed the default sampler, used by random_trunc and random_trunc_array"""
+    sampler.seed(seed)
+
+def random_trunc(mean=0, sd=1, low=0, upp=20, sampler=sampler):
+    return sampler.draw(mean=mean, sd=sd, low=low, upp=upp)
+
+def random_trunc_array(mean=0, sd=1, low=0, upp=20, size=None, sampler=sampler):
+    """Draw truncated normal samples for arrays of means and bounds at once"""
+    return sampler.sample(mean=mean, sd=sd, low=low, upp=upp, size=size)
 
 def get_truncated_normal(mean=0, sd=1, low=0, upp=10):
+    from scipy.stats import truncnorm
     return truncnorm(
-        (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd)
\ No newline at end of file
+        (low - mean) / sd, (upp - mean) / sd, loc=mean, scale=sd)
@@ -0,0 +1,85 @@
+from math import atan2, acos, cos, sin, hypot, nan
+
+
+class Vector:
+    """
+    2D vector with the part of the p5.Vector interface, that the model uses
+
+    Works on plain floats, so the model runs without p5 (and glfw), and it's much faster
+    than p5.Vector, that keeps 3 float32 values in a numpy array.
+    """
+
+    __slots__ = ('x', 'y')
+
+    def __init__(self, x, y, z=0):
+        # z is accepted for p5.Vector(x, y, z) compatibility and ignored
+        self.x = float(x)
+        self.y = float(y)
+
+    def __add__(self, other):
+        return Vector(self.x + other.x, self.y + other.y)
+
+    def __sub__(self, other):
+        return Vector(self.x - other.x, self.y - other.y)
+
+    def __mul__(self, k):
+        return Vector(self.x * k, self.y * k)
+
+    def __rmul__(self, k):
+        return self * k
+
+    def __truediv__(self, k):
+        return Vector(self.x / k, self.y / k)
+
+    def __neg__(self):
+        return Vector(-self.x, -self.y)
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __getitem__(self, key):
+        return (self.x, self.y)[key]
+
+    def __repr__(self):
+        return f'Vector({self.x:.2f}, {self.y:.2f})'
+
+    def copy(self):
+        return Vector(self.x, self.y)
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y
+
+    def distance(self, other):
+        return hypot(self.x - other.x, self.y - other.y)
+
+    @property
+    def magnitude(self):
+        return hypot(self.x, self.y)
+
+    @property
+    def angle(self):
+        return atan2(self.y, self.x)
+
+    def angle_between(self, other):
+        """Angle between the vectors in [0, pi], nan if one of them is zero (like p5)"""
+        magnitudes = self.magnitude * other.magnitude
+        if not magnitudes:
+            return nan
+
+        return acos(min(max(self.dot(other) / magnitudes, -1.0), 1.0))
+
+    def rotate(self, theta):
+        """Rotate the vector itself by theta (radians)"""
+        x = self.x * cos(theta) - self.y * sin(theta)
+        self.y = self.x * sin(theta) + self.y * cos(theta)
+        self.x = x
+
+    def normalize(self):
+        """Set the magnitude of the vector itself to one"""
+        magnitude = self.magnitude
+        if magnitude == 0:
+            raise ValueError("Vector has magnitude 0; can't normalize.")
+
+        self.x /= magnitude
+        self.y /= magnitude